@@ -0,0 +1,286 @@
+#!/usr/bin/env python2
+
+"""Measure crawl, extraction and solve times of `eprc calc` on synthetic
+package universes, without network, Redis or Java.
+
+Packages are generated as sdists with a `setup.py` and served by a local
+stand-in for `PyPi`, records are stored in memory. By default, setup.py
+files are run with the interpreter of this script (which needs `mock`)
+instead of fresh virtualenvs, use `--virtualenv` to include those.
+
+Usage: python2 benchmarks/calc.py [--sizes 10 50 100] [--fanout 3]"""
+
+import argparse
+import contextlib
+import hashlib
+import logging
+import os
+import os.path
+import random
+import shutil
+import sys
+import tarfile
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from eprc import backends, database, extractor, scheduler, solver, utils  # noqa
+from solvers import quiet  # noqa
+
+
+SETUP_PY = """from setuptools import setup
+
+setup(
+    name={name!r},
+    version={version!r},
+    install_requires={install_requires!r},
+    extras_require={extras_require!r}
+)
+"""
+
+
+def write_project(path, name, version, install_requires, extras_require=None):
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    with open(os.path.join(path, 'setup.py'), 'w') as outfile:
+        outfile.write(SETUP_PY.format(
+            name=name,
+            version=version,
+            install_requires=install_requires,
+            extras_require=extras_require or {}
+        ))
+
+
+def write_sdist(indexdir, name, version, install_requires, extras_require=None):
+    """Write `NAME-VERSION.tar.gz` to `indexdir/NAME/` and return its path."""
+    scratch = tempfile.mkdtemp()
+    try:
+        basename = '{}-{}'.format(name, version)
+        write_project(os.path.join(scratch, basename), name, version, install_requires, extras_require)
+
+        directory = os.path.join(indexdir, name)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        path = os.path.join(directory, basename + '.tar.gz')
+        with tarfile.open(path, 'w:gz') as archive:
+            archive.add(os.path.join(scratch, basename), arcname=basename)
+        return path
+    finally:
+        shutil.rmtree(scratch)
+
+
+def generate(indexdir, rng, packages, versions, fanout, conflicts):
+    """Write a random universe to `indexdir` and return the path of the root
+    project.
+
+    Packages only depend on packages with a higher number, the root project
+    depends on the first `fanout` of them. Every version has up to `fanout`
+    requirements, a share of `conflicts` of them excludes most versions of
+    the required package, the others accept most versions."""
+    names = ['p{}'.format(i) for i in xrange(packages)]
+    for i, name in enumerate(names):
+        candidates = names[i + 1:]
+        for v in xrange(versions):
+            install_requires = []
+            for dep in rng.sample(candidates, min(fanout, len(candidates))):
+                bound = rng.randint(0, versions - 1)
+                if rng.random() < conflicts:
+                    install_requires.append('{}<{}.0'.format(dep, max(bound, 1)))
+                elif rng.random() < 0.5:
+                    install_requires.append('{}>={}.0'.format(dep, bound // 2))
+                else:
+                    install_requires.append(dep)
+            write_sdist(indexdir, name, '{}.0'.format(v), install_requires)
+
+    rootdir = os.path.join(os.path.dirname(indexdir), 'root')
+    write_project(rootdir, 'root', '1.0', names[:fanout])
+    return rootdir
+
+
+class LocalIndex(object):
+    """Stand-in for `PyPi` that serves the sdists of a directory
+    (`NAME/NAME-VERSION.tar.gz`) via file:// URLs."""
+    def __init__(self, indexdir):
+        self.releases = {}  # name -> {version: path}
+        for name in os.listdir(indexdir):
+            self.releases[name] = dict(
+                (filename[len(name) + 1:-len('.tar.gz')], os.path.join(indexdir, name, filename))
+                for filename in os.listdir(os.path.join(indexdir, name))
+            )
+
+    def close(self):
+        pass
+
+    def real_name(self, package_name, timeout=None):
+        return utils.normalize(package_name)
+
+    def lookup_many(self, names):
+        return [
+            (utils.normalize(name), list(self.releases[utils.normalize(name)]))
+            if utils.normalize(name) in self.releases else None
+            for name in names
+        ]
+
+    def prefetch_release_urls(self, jobs):
+        pass
+
+    def release_urls(self, name, version):
+        path = self.releases[utils.normalize(name)][version]
+        with open(path, 'rb') as infile:
+            md5 = hashlib.md5(infile.read()).hexdigest()
+        return [{
+            'packagetype': 'sdist',
+            'url': 'file://' + os.path.abspath(path),
+            'md5_digest': md5
+        }]
+
+
+class _HostPython(object):
+    """Stand-in for `VirtualenvPool` that hands out the environment of the
+    running interpreter."""
+    @contextlib.contextmanager
+    def acquire(self):
+        yield sys.prefix
+
+
+class TimedExtractor(extractor.Extractor):
+    """`Extractor` that sums up the time spent per extraction."""
+    def __init__(self, *args, **kwargs):
+        self.host_python = kwargs.pop('host_python')
+        super(TimedExtractor, self).__init__(*args, **kwargs)
+        self.extract_time = 0.0
+        self.extract_count = 0
+        self.timer_lock = threading.Lock()
+
+    def _venv_pool(self, packages):
+        if self.host_python:
+            return _HostPython()
+        return super(TimedExtractor, self)._venv_pool(packages)
+
+    def from_path(self, path, db, name=None, version=None):
+        start = time.time()
+        try:
+            return super(TimedExtractor, self).from_path(path, db, name, version)
+        finally:
+            with self.timer_lock:
+                self.extract_time += time.time() - start
+                self.extract_count += 1
+
+
+def run(tmpdir, rootdir, indexdir, args):
+    """Run the steps of `eprc calc` and return `(crawl time, extraction
+    time, extractions, solve time, cost)`."""
+    db = database.CachedDatabase(database.Database(backends.MemoryBackend()))
+    pypi = LocalIndex(indexdir)
+    the_extractor = TimedExtractor(
+        virtualenv=args.virtualenv,
+        tmpdir=tmpdir,
+        pypi=pypi,
+        venv_pool_size=args.jobs,
+        fork_server=not args.no_fork_server,
+        host_python=not args.virtualenv
+    )
+    the_scheduler = scheduler.Scheduler(
+        db=db,
+        extractor=the_extractor,
+        pypi=pypi,
+        verbosity=sys.maxint,
+        jobs=args.jobs
+    )
+    try:
+        start = time.time()
+        data = the_extractor.from_path(rootdir, db)
+        the_scheduler.add_todos_from_db(data['name'], data['version'])
+        the_scheduler.done_with_all_versions(data['name'], '')
+        todos = the_scheduler.get_many(args.jobs)
+        while todos:
+            the_scheduler.process_extract_many(todos)
+            todos = the_scheduler.get_many(args.jobs)
+        crawl_time = time.time() - start
+
+        start = time.time()
+        with quiet():
+            solution = solver.solve(
+                the_scheduler,
+                db,
+                [(utils.normalize(data['name']), utils.normalize(data['version']))],
+                tmpdir,
+                args.solver,
+                os.path.join(tmpdir, 'requirements.txt')
+            )
+        solve_time = time.time() - start
+    finally:
+        the_scheduler.close()
+        the_extractor.close()
+
+    return (
+        crawl_time,
+        the_extractor.extract_time,
+        the_extractor.extract_count,
+        solve_time,
+        solution.cost if solution else None
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[5, 10, 20])
+    parser.add_argument('--versions', type=int, default=5)
+    parser.add_argument('--fanout', type=int, default=3)
+    parser.add_argument(
+        '--conflicts',
+        type=float,
+        default=0.1,
+        help='Share of requirements that exclude most versions.'
+    )
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--jobs', type=int, default=1)
+    parser.add_argument(
+        '--solver',
+        type=str,
+        default=solver.BUILTIN_SOLVER,
+        help='Solver command, the built-in solver by default.'
+    )
+    parser.add_argument(
+        '--virtualenv',
+        type=str,
+        default=None,
+        help='Run extractors in virtualenvs created by this command (needs '
+        'network access to install mock) instead of this interpreter.'
+    )
+    parser.add_argument('--no-fork-server', action='store_true')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.ERROR)
+
+    print("{:>8} {:>8} {:>10} {:>12} {:>10} {:>10} {:>6}".format(
+        "packages", "versions", "crawl[s]", "extract[s]", "extracted", "solve[s]", "cost"
+    ))
+    for size in args.sizes:
+        tmpdir = tempfile.mkdtemp()
+        try:
+            indexdir = os.path.join(tmpdir, 'index')
+            rootdir = generate(
+                indexdir,
+                random.Random(args.seed),
+                size,
+                args.versions,
+                args.fanout,
+                args.conflicts
+            )
+
+            workdir = os.path.join(tmpdir, 'work')
+            os.makedirs(workdir)
+            crawl_time, extract_time, extracted, solve_time, cost = run(workdir, rootdir, indexdir, args)
+
+            print("{:>8} {:>8} {:>10.3f} {:>12.3f} {:>10} {:>10.3f} {:>6}".format(
+                size, size * args.versions, crawl_time, extract_time, extracted, solve_time, cost
+            ))
+        finally:
+            shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    main()
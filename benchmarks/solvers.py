@@ -0,0 +1,150 @@
+#!/usr/bin/env python2
+
+"""Compare the built-in solver with an external OPB solver (sat4j by default)
+on synthetic instances of growing size.
+
+Usage: python2 benchmarks/solvers.py [--sizes 10 50 100] [--solver CMD]"""
+
+import argparse
+import contextlib
+import os
+import os.path
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from eprc import backends, database, solver  # noqa
+
+
+class FakeScheduler(object):
+    """Just enough of `Scheduler` for `solver.solve`."""
+    def __init__(self, names):
+        self.done = set((name, '') for name in names)
+
+
+def requirement(name, specs=()):
+    return {
+        'name': name,
+        'extras': [],
+        'specs': [{'op': op, 'version': version} for op, version in specs]
+    }
+
+
+def generate(db, rng, packages, versions, requirements):
+    """Fill `db` with a random universe and return all package names.
+
+    Packages only depend on packages with a higher number, the root package
+    depends on the first few of them."""
+    names = ['p{}'.format(i) for i in xrange(packages)]
+    for i, name in enumerate(names):
+        for v in xrange(versions):
+            install_requires = []
+            candidates = names[i + 1:]
+            for dep in rng.sample(candidates, min(requirements, len(candidates))):
+                bound = str(rng.randint(0, versions - 1))
+                op = rng.choice(['>=', '<', '!=', None])
+                install_requires.append(
+                    requirement(dep, [(op, bound)] if op else [])
+                )
+            db.set(name, str(v), {
+                'name': name,
+                'version': str(v),
+                'install_requires': install_requires,
+                'setup_requires': [],
+                'tests_require': [],
+                'extras_require': {}
+            })
+
+    db.set('root', '1', {
+        'name': 'root',
+        'version': '1',
+        'install_requires': [requirement(name) for name in names[:3]],
+        'setup_requires': [],
+        'tests_require': [],
+        'extras_require': {}
+    })
+    return names + ['root']
+
+
+@contextlib.contextmanager
+def quiet():
+    # external solvers write their output to STDOUT
+    stdout = os.dup(1)
+    with open(os.devnull, 'w') as devnull:
+        sys.stdout.flush()
+        os.dup2(devnull.fileno(), 1)
+        try:
+            yield
+        finally:
+            sys.stdout.flush()
+            os.dup2(stdout, 1)
+            os.close(stdout)
+
+
+def run(tmpdir, names, db, solver_cmd):
+    start = time.time()
+    with quiet():
+        solution = solver.solve(
+            FakeScheduler(names),
+            db,
+            [('root', '1')],
+            tmpdir,
+            solver_cmd,
+            os.path.join(tmpdir, 'requirements.txt')
+        )
+    return time.time() - start, solution.cost if solution else None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[5, 10, 15, 20])
+    parser.add_argument('--versions', type=int, default=10)
+    parser.add_argument('--requirements', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument(
+        '--solver',
+        type=str,
+        default='java -jar {}'.format(os.path.join(
+            os.path.dirname(__file__), '..', 'eprc', 'sat4j-pb.jar'
+        )),
+        help='External solver, use an empty string to skip it.'
+    )
+    args = parser.parse_args()
+
+    print("{:>8} {:>8} {:>12} {:>12} {:>8}".format(
+        "packages", "versions", "builtin[s]", "external[s]", "same"
+    ))
+    for size in args.sizes:
+        tmpdir = tempfile.mkdtemp()
+        try:
+            db = database.Database(
+                backends.SqliteBackend(os.path.join(tmpdir, 'eprc.db'))
+            )
+            names = generate(
+                db,
+                random.Random(args.seed),
+                size,
+                args.versions,
+                args.requirements
+            )
+
+            builtin_time, builtin_cost = run(tmpdir, names, db, solver.BUILTIN_SOLVER)
+            if args.solver:
+                external_time, external_cost = run(tmpdir, names, db, args.solver)
+                same = 'yes' if builtin_cost == external_cost else 'NO'
+            else:
+                external_time, same = float('nan'), '-'
+
+            print("{:>8} {:>8} {:>12.3f} {:>12.3f} {:>8}".format(
+                size, size * args.versions, builtin_time, external_time, same
+            ))
+        finally:
+            shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,114 +1,274 @@
 import argparse
+import contextlib
 import itertools
 import logging
+import os.path
 import pkg_resources
 import pprint
+import time
 
-from database import Database
+import backends
+from database import CachedDatabase, Database
+from downloadcache import DownloadCache
 from extractor import Extractor
-from pypi import PyPi
+from pypi import PyPi, build_index
 from scheduler import Scheduler
+from solverdaemon import DEFAULT_SOCKET, SolverDaemon
+import profiling
 import solver
 import utils
 
 
+def open_database(args):
+    if args.db_url:
+        backend = backends.from_url(args.db_url)
+    else:
+        backend = backends.RedisBackend(
+            host=args.redis_host,
+            port=args.redis_port,
+            db=args.redis_db
+        )
+
+    if profiling.is_enabled():
+        backend = profiling.ProfiledBackend(backend)
+    return Database(backend)
+
+
+@contextlib.contextmanager
+def profiling_hooks(args):
+    """Enable the profiling options of `calc` for the block."""
+    if args.profile_report:
+        profiling.enable()
+
+    hooks = []
+    if args.profile_cprofile:
+        hooks.append(profiling.cprofile(args.profile_cprofile))
+    if args.profile_tracemalloc:
+        hooks.append(profiling.trace_allocations())
+
+    try:
+        with contextlib.nested(*hooks):
+            yield
+    finally:
+        if args.profile_report:
+            profiling.write_report(args.profile_report)
+            profiling.disable()
+
+
 def run_calc(args):
     try:
-        with utils.TemporaryDirectory() as tmpdir:
+        with utils.TemporaryDirectory() as tmpdir, profiling_hooks(args):
             logging.getLogger().setLevel(logging.INFO)
             logging.basicConfig(
                 format="%(asctime)s [%(levelname)s]: %(message)s"
             )
-            pypi = PyPi()
+
+            db = CachedDatabase(
+                open_database(args),
+                max_entries=args.record_cache_size
+            )
+            db.check_schema()
+            pypi = PyPi(
+                db=db,
+                real_name_ttl=args.real_name_ttl,
+                concurrency=args.pypi_concurrency,
+                index=args.index
+            )
+
+            download_cache = None
+            if args.download_cache:
+                download_cache = DownloadCache(
+                    args.download_cache,
+                    max_size=args.download_cache_size * 1024 * 1024
+                )
+
             extractor = Extractor(
                 virtualenv=args.virtualenv,
                 tmpdir=tmpdir,
-                pypi=pypi
-            )
-            db = Database(
-                host=args.redis_host,
-                port=args.redis_port,
-                db=args.redis_db
+                pypi=pypi,
+                venv_pool_size=args.jobs,
+                fork_server=not args.no_fork_server,
+                extract_timeout=args.extract_timeout,
+                download_cache=download_cache
             )
             scheduler = Scheduler(
                 db=db,
                 extractor=extractor,
-                pypi=pypi
+                pypi=pypi,
+                jobs=args.jobs,
+                retry_failed_after=args.retry_failed_after,
+                lazy_batch=args.lazy
             )
 
             # start with given paths
             # also remember what we have got here,
             # because it is important for the PBO part later
             must_satisfy = []
-            for p in args.paths:
-                splitted = p.split(':')
-                cwd = splitted[0]
-                if len(splitted) > 1:
-                    extras = splitted[1].split(',')
-                else:
-                    extras = []
-
-                data = extractor.from_path(cwd, db)
-
-                must_satisfy.append(
-                    (
-                        utils.normalize(data['name']),
-                        utils.normalize(data['version'])
+            with profiling.phase("roots"):
+                for p in args.paths:
+                    splitted = p.split(':')
+                    cwd = splitted[0]
+                    if len(splitted) > 1:
+                        extras = splitted[1].split(',')
+                    else:
+                        extras = []
+
+                    data = extractor.from_path(cwd, db)
+
+                    must_satisfy.append(
+                        (
+                            utils.normalize(data['name']),
+                            utils.normalize(data['version'])
+                        )
                     )
-                )
-                scheduler.add_todos_from_db(data['name'], data['version'], '')
-                scheduler.done_with_all_versions(data['name'], '')
-                for e in itertools.chain([''], extras):
-                    scheduler.add_todos_from_db(
-                        data['name'],
-                        data['version'],
-                        e
+                    scheduler.add_todos_from_db(data['name'], data['version'], '')
+                    scheduler.done_with_all_versions(data['name'], '')
+                    for e in itertools.chain([''], extras):
+                        scheduler.add_todos_from_db(
+                            data['name'],
+                            data['version'],
+                            e
+                        )
+                        scheduler.done_with_all_versions(data['name'], e)
+
+            lazy = args.lazy and not args.cached
+            try:
+                while True:
+                    # run until no tasks left
+                    with profiling.phase("crawl"):
+                        todos = scheduler.get_many(args.jobs)
+                        while todos:
+                            if args.cached:
+                                for name, extra in todos:
+                                    scheduler.process_cached(name, extra)
+                            else:
+                                scheduler.process_extract_many(todos)
+                            todos = scheduler.get_many(args.jobs)
+
+                    # finally solve our problem
+                    with profiling.phase("solve"):
+                        solution = solver.solve(
+                            scheduler,
+                            db,
+                            must_satisfy,
+                            tmpdir,
+                            args.solver,
+                            args.outfile,
+                            args.include_starting_points,
+                            releases=scheduler.releases if lazy else None,
+                            builtin_threshold=args.builtin_solver_threshold,
+                            daemon=args.solver_daemon,
+                            solution_cache=not args.no_solution_cache,
+                            warm_start=not args.no_warm_start,
+                            solution_max_age=args.solution_max_age
+                        )
+
+                    # in lazy mode, continue with older versions until the
+                    # optimum is proven
+                    if not lazy:
+                        break
+                    names = scheduler.expansion_candidates(solution)
+                    if not names:
+                        break
+                    logging.info(
+                        "Extract older versions of {} packages".format(len(names))
                     )
-                    scheduler.done_with_all_versions(data['name'], e)
-
-            # run until no tasks left
-            todo = scheduler.get()
-            while todo:
-                (name, extra) = todo
-
-                if args.cached:
-                    scheduler.process_cached(name, extra)
-                else:
-                    scheduler.process_extract(name, extra)
-                todo = scheduler.get()
-
-            # finally solve our problem
-            solver.solve(
-                scheduler,
-                db,
-                must_satisfy,
-                tmpdir,
-                args.solver,
-                args.outfile,
-                args.include_starting_points
-            )
+                    with profiling.phase("expand"):
+                        scheduler.expand(names)
+            finally:
+                scheduler.close()
+                extractor.close()
+                pypi.close()
+
+            logging.info(str(db))
 
     except utils.HandledError as e:
         logging.error(e.message)
 
 
 def run_get(args):
-    db = Database(
-        host=args.redis_host,
-        port=args.redis_port,
-        db=args.redis_db
-    )
+    db = open_database(args)
+
+    try:
+        db.check_schema()
+    except utils.HandledError as e:
+        logging.error(e.message)
+        return
 
     if args.version:
         pprint.pprint(db.get(args.name, args.version))
     else:
-        pprint.pprint([
-            db.get(args.name, version)
-            for version in db.all_versions(args.name)
-        ])
+        pprint.pprint(db.all_records(args.name).values())
+
+
+def run_failures(args):
+    db = open_database(args)
+
+    if args.clear:
+        print("Cleared {} failures".format(db.clear_failures(args.name)))
+    else:
+        for name, version, entry in db.all_failures(args.name):
+            print("{}:{}  {}  {}".format(
+                name,
+                version,
+                time.strftime(
+                    "%Y-%m-%d %H:%M:%S",
+                    time.localtime(entry['timestamp'])
+                ),
+                entry['reason']
+            ))
+
+
+def run_solver_daemon(args):
+    logging.getLogger().setLevel(logging.INFO)
+    logging.basicConfig(
+        format="%(asctime)s [%(levelname)s]: %(message)s"
+    )
+
+    try:
+        SolverDaemon(
+            solver=args.solver,
+            socket_path=args.socket,
+            spares=args.spares
+        ).serve_forever()
+    except KeyboardInterrupt:
+        pass
+    except utils.HandledError as e:
+        logging.error(e.message)
+
+
+def run_build_index(args):
+    logging.getLogger().setLevel(logging.INFO)
+    logging.basicConfig(
+        format="%(asctime)s [%(levelname)s]: %(message)s"
+    )
+
+    count = build_index(args.directory)
+    logging.info("Listed {} files in {}".format(count, args.directory))
+
+
+def run_migrate(args):
+    logging.getLogger().setLevel(logging.INFO)
+    logging.basicConfig(
+        format="%(asctime)s [%(levelname)s]: %(message)s"
+    )
+    db = open_database(args)
+
+    count = db.migrate()
+    logging.info("Migrated {} records".format(count))
+
+
+def run_clear_solutions(args):
+    db = open_database(args)
+
+    print("Cleared {} solutions".format(db.clear_solutions(args.max_age)))
 
 
 def run():
+    default_solver = "java -jar {}".format(
+        pkg_resources.resource_filename(__name__, "sat4j-pb.jar")
+    )
+
     parser = argparse.ArgumentParser(
         prog='eprc',
         description='Experimental Python Requirements Calculator',
@@ -127,7 +287,7 @@ def run():
         '--redis-port',
         help='Redis port',
         type=int,
-        default=6378
+        default=backends.DEFAULT_REDIS_PORT
     )
 
     parser.add_argument(
@@ -137,6 +297,17 @@ def run():
         default=0
     )
 
+    parser.add_argument(
+        '--db-url',
+        help='Database URL, e.g. `redis://localhost:{}/0` or '
+        '`sqlite:///path/to/eprc.db` (four slashes for absolute paths) or '
+        '`memory://` (nothing is kept). Overrides the Redis options.'.format(
+            backends.DEFAULT_REDIS_PORT
+        ),
+        type=str,
+        default=None
+    )
+
     subparsers = parser.add_subparsers()
 
     parser_calc = subparsers.add_parser(
@@ -154,6 +325,99 @@ def run():
         default="virtualenv2"
     )
 
+    parser_calc.add_argument(
+        "-j", "--jobs",
+        help='Number of packages/versions that are extracted concurrently.',
+        type=int,
+        default=1
+    )
+
+    parser_calc.add_argument(
+        "--no-fork-server",
+        help='Start a new interpreter for every setup.py instead of forking '
+        'it from a preloaded extractor server.',
+        action="store_true",
+        default=False
+    )
+
+    parser_calc.add_argument(
+        "--extract-timeout",
+        help='Seconds after which a setup.py run by the fork server gets '
+        'killed.',
+        type=float,
+        default=300.0
+    )
+
+    parser_calc.add_argument(
+        "--download-cache",
+        help='Directory used to cache downloaded source packages. Use an '
+        'empty string to disable the persistent cache.',
+        type=str,
+        default=os.path.join(
+            os.path.expanduser("~"),
+            ".cache",
+            "eprc",
+            "downloads"
+        )
+    )
+
+    parser_calc.add_argument(
+        "--download-cache-size",
+        help='Maximum size of the download cache in MiB.',
+        type=int,
+        default=2048
+    )
+
+    parser_calc.add_argument(
+        "--record-cache-size",
+        help='Number of decoded package records kept in memory.',
+        type=int,
+        default=50000
+    )
+
+    parser_calc.add_argument(
+        "--real-name-ttl",
+        help='Seconds for which resolved PyPi package names are cached in '
+        'the database.',
+        type=int,
+        default=7 * 24 * 60 * 60
+    )
+
+    parser_calc.add_argument(
+        "--pypi-concurrency",
+        help='Number of concurrent PyPi requests.',
+        type=int,
+        default=8
+    )
+
+    parser_calc.add_argument(
+        "--index",
+        help='Look up packages in a local index instead of PyPi, so no '
+        'network access is needed. Either a directory with an `index.json` '
+        '(see `eprc build-index`), the JSON file or a file:// URL.',
+        type=str,
+        default=None
+    )
+
+    parser_calc.add_argument(
+        "--retry-failed-after",
+        help='Seconds after which versions that failed to extract are '
+        'retried.',
+        type=int,
+        default=30 * 24 * 60 * 60
+    )
+
+    parser_calc.add_argument(
+        "-l", "--lazy",
+        help='Only extract the N newest versions of every package and solve. '
+        'Older versions are only extracted for packages that could lead to a '
+        'better solution (or any solution at all), repeated until the optimum '
+        'is proven.',
+        metavar='N',
+        type=int,
+        default=None
+    )
+
     parser_calc.add_argument(
         'paths',
         help='Paths of the packages you want the requirements calculate for.',
@@ -184,11 +448,81 @@ def run():
         'finding a feasable and good set of packages to install. It must '
         'accept OPB files and must write the solution to STDOUT. See the '
         'following PDF for a complete specification: '
-        'http://www.cril.univ-artois.fr/PB12/format.pdf',
+        'http://www.cril.univ-artois.fr/PB12/format.pdf . Use `{}` for the '
+        'built-in solver.'.format(solver.BUILTIN_SOLVER),
         type=str,
-        default="java -jar {}".format(
-            pkg_resources.resource_filename(__name__, "sat4j-pb.jar")
-        )
+        default=default_solver
+    )
+
+    parser_calc.add_argument(
+        "--solver-daemon",
+        help='Pass problems for the external solver to the solver daemon '
+        'listening on this socket (see `eprc solver-daemon`). Falls back to '
+        'running --solver directly if the daemon is not reachable.',
+        metavar='SOCKET',
+        nargs='?',
+        const=DEFAULT_SOCKET,
+        type=str,
+        default=None
+    )
+
+    parser_calc.add_argument(
+        "--builtin-solver-threshold",
+        help='Use the built-in solver instead of --solver if the problem has '
+        'at most this many variables for package versions. 0 disables this.',
+        type=int,
+        default=100
+    )
+
+    parser_calc.add_argument(
+        "--no-solution-cache",
+        help='Always run the solver, even if the database contains a '
+        'solution of an identical problem.',
+        action="store_true",
+        default=False
+    )
+
+    parser_calc.add_argument(
+        "--no-warm-start",
+        help='Do not use the previous solution for the same paths to speed '
+        'up the solver.',
+        action="store_true",
+        default=False
+    )
+
+    parser_calc.add_argument(
+        "--solution-max-age",
+        help='Seconds after which stored solutions are not used anymore, '
+        'see `eprc clear-solutions` to remove them.',
+        type=int,
+        default=30 * 24 * 60 * 60
+    )
+
+    parser_calc.add_argument(
+        "--profile-report",
+        help='Write wall times and counts of PyPi calls, downloads, '
+        'virtualenvs, extractor runs, database access, record decoding and '
+        'solver runs per phase and per package as JSON to this file.',
+        metavar='PATH',
+        type=str,
+        default=None
+    )
+
+    parser_calc.add_argument(
+        "--profile-cprofile",
+        help='Profile the main thread with cProfile and write the statistics '
+        'to this file (see `python -m pstats`).',
+        metavar='PATH',
+        type=str,
+        default=None
+    )
+
+    parser_calc.add_argument(
+        "--profile-tracemalloc",
+        help='Add the top allocation sites to --profile-report (needs '
+        'tracemalloc).',
+        action="store_true",
+        default=False
     )
 
     parser_calc.add_argument(
@@ -217,7 +551,90 @@ def run():
         type=str
     )
 
+    parser_failures = subparsers.add_parser(
+        'failures',
+        help='Lists or clears package versions that failed to extract.'
+    )
+    parser_failures.set_defaults(func=run_failures)
+
+    parser_failures.add_argument(
+        'name',
+        help='Optional package name.',
+        nargs='?',
+        type=str
+    )
+
+    parser_failures.add_argument(
+        "--clear",
+        help='Clear failures, so they get retried by the next run.',
+        action="store_true",
+        default=False
+    )
+
+    parser_solver_daemon = subparsers.add_parser(
+        'solver-daemon',
+        help='Runs a service that keeps solver processes started, so `eprc '
+        'calc --solver-daemon` does not have to wait for their startup.'
+    )
+    parser_solver_daemon.set_defaults(func=run_solver_daemon)
+
+    parser_solver_daemon.add_argument(
+        "-s", "--solver",
+        help='The solver command, see `eprc calc --help`.',
+        type=str,
+        default=default_solver
+    )
+
+    parser_solver_daemon.add_argument(
+        "--socket",
+        help='Path of the unix socket to listen on.',
+        type=str,
+        default=DEFAULT_SOCKET
+    )
+
+    parser_solver_daemon.add_argument(
+        "--spares",
+        help='Number of solver processes that are kept waiting for problems.',
+        type=int,
+        default=1
+    )
+
+    parser_migrate = subparsers.add_parser(
+        'migrate',
+        help='Upgrades a database that was created by an older version of '
+        'eprc.'
+    )
+    parser_migrate.set_defaults(func=run_migrate)
+
+    parser_clear_solutions = subparsers.add_parser(
+        'clear-solutions',
+        help='Removes stored solutions and warm starts of `calc`.'
+    )
+    parser_clear_solutions.set_defaults(func=run_clear_solutions)
+
+    parser_clear_solutions.add_argument(
+        "--max-age",
+        help='Only remove entries older than this many seconds.',
+        type=int,
+        default=None
+    )
+
+    parser_build_index = subparsers.add_parser(
+        'build-index',
+        help='Writes the `index.json` listing of all source packages and '
+        'wheels in a directory, which can be used by `calc --index`.'
+    )
+    parser_build_index.set_defaults(func=run_build_index)
+
+    parser_build_index.add_argument(
+        'directory',
+        help='Directory with the packages (e.g. a wheelhouse).',
+        type=str
+    )
+
     args = parser.parse_args()
+    if args.func is run_calc and args.profile_tracemalloc and not args.profile_report:
+        parser_calc.error("--profile-tracemalloc needs --profile-report")
     args.func(args)
 
 if __name__ == '__main__':
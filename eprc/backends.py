@@ -0,0 +1,226 @@
+import contextlib
+import redis
+import sqlite3
+import threading
+import urlparse
+
+import utils
+
+
+DEFAULT_REDIS_PORT = 6378
+
+
+class RedisBackend(object):
+    """Storage backend that uses a Redis server."""
+    def __init__(self, host='localhost', port=DEFAULT_REDIS_PORT, db=0):
+        self.redis = redis.StrictRedis(host=host, port=port, db=db)
+
+    def get_many(self, keys):
+        keys = list(keys)
+        if not keys:
+            return []
+        return self.redis.mget(keys)
+
+    def members(self, key):
+        return self.redis.smembers(key)
+
+    def iter_keys(self, batch_size=1000):
+        # SCAN does not block the server like KEYS does
+        return self.redis.scan_iter(count=batch_size)
+
+    @contextlib.contextmanager
+    def batch(self):
+        """Collect writes and execute them in one round trip."""
+        pipe = self.redis.pipeline()
+        yield _RedisBatch(pipe)
+        pipe.execute()
+
+
+class _RedisBatch(object):
+    def __init__(self, pipe):
+        self.pipe = pipe
+
+    def set(self, key, value):
+        self.pipe.set(key, value)
+
+    def delete(self, key):
+        self.pipe.delete(key)
+
+    def add_member(self, key, member):
+        self.pipe.sadd(key, member)
+
+    def remove_member(self, key, member):
+        self.pipe.srem(key, member)
+
+
+class SqliteBackend(object):
+    """Embedded storage backend that keeps everything in a single SQLite
+    file."""
+    # stay below SQLITE_MAX_VARIABLE_NUMBER
+    CHUNK_SIZE = 500
+
+    def __init__(self, path):
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.text_factory = str
+        self.lock = threading.Lock()
+
+        with self.lock, self.conn:
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("PRAGMA synchronous=NORMAL")
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS kv ("
+                "key TEXT PRIMARY KEY, "
+                "value BLOB NOT NULL)"
+            )
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS members ("
+                "key TEXT NOT NULL, "
+                "member TEXT NOT NULL, "
+                "PRIMARY KEY (key, member))"
+            )
+
+    def get_many(self, keys):
+        keys = list(keys)
+        found = {}
+        with self.lock:
+            for i in xrange(0, len(keys), self.CHUNK_SIZE):
+                chunk = keys[i:i + self.CHUNK_SIZE]
+                cursor = self.conn.execute(
+                    "SELECT key, value FROM kv WHERE key IN ({})".format(
+                        ",".join("?" * len(chunk))
+                    ),
+                    chunk
+                )
+                for key, value in cursor:
+                    found[key] = str(value)
+        return [found.get(key) for key in keys]
+
+    def members(self, key):
+        with self.lock:
+            return set(
+                member
+                for (member,) in self.conn.execute(
+                    "SELECT member FROM members WHERE key = ?",
+                    (key,)
+                )
+            )
+
+    def iter_keys(self, batch_size=1000):
+        with self.lock:
+            keys = [
+                key
+                for (key,) in self.conn.execute("SELECT key FROM kv")
+            ]
+        return iter(keys)
+
+    @contextlib.contextmanager
+    def batch(self):
+        """Run all writes in one transaction."""
+        with self.lock, self.conn:
+            yield _SqliteBatch(self.conn)
+
+
+class _SqliteBatch(object):
+    def __init__(self, conn):
+        self.conn = conn
+
+    def set(self, key, value):
+        self.conn.execute(
+            "INSERT OR REPLACE INTO kv (key, value) VALUES (?, ?)",
+            (key, sqlite3.Binary(value))
+        )
+
+    def delete(self, key):
+        self.conn.execute("DELETE FROM kv WHERE key = ?", (key,))
+        self.conn.execute("DELETE FROM members WHERE key = ?", (key,))
+
+    def add_member(self, key, member):
+        self.conn.execute(
+            "INSERT OR IGNORE INTO members (key, member) VALUES (?, ?)",
+            (key, member)
+        )
+
+    def remove_member(self, key, member):
+        self.conn.execute(
+            "DELETE FROM members WHERE key = ? AND member = ?",
+            (key, member)
+        )
+
+
+class MemoryBackend(object):
+    """Storage backend that keeps everything in memory of the current
+    process, e.g. for benchmarks and one-off runs. Nothing is persisted."""
+    def __init__(self):
+        self.data = {}     # key -> value
+        self.sets = {}     # key -> set(member)
+        self.lock = threading.Lock()
+
+    def get_many(self, keys):
+        with self.lock:
+            return [self.data.get(key) for key in keys]
+
+    def members(self, key):
+        with self.lock:
+            return set(self.sets.get(key, ()))
+
+    def iter_keys(self, batch_size=1000):
+        with self.lock:
+            return iter(list(self.data))
+
+    @contextlib.contextmanager
+    def batch(self):
+        """Collect writes and apply them at once if the block succeeds."""
+        batch = _MemoryBatch()
+        yield batch
+        with self.lock:
+            for operation, key, arg in batch.operations:
+                if operation == 'set':
+                    self.data[key] = arg
+                elif operation == 'delete':
+                    self.data.pop(key, None)
+                    self.sets.pop(key, None)
+                elif operation == 'add_member':
+                    self.sets.setdefault(key, set()).add(arg)
+                else:
+                    self.sets.get(key, set()).discard(arg)
+
+
+class _MemoryBatch(object):
+    def __init__(self):
+        self.operations = []  # (operation, key, value or member)
+
+    def set(self, key, value):
+        self.operations.append(('set', key, value))
+
+    def delete(self, key):
+        self.operations.append(('delete', key, None))
+
+    def add_member(self, key, member):
+        self.operations.append(('add_member', key, member))
+
+    def remove_member(self, key, member):
+        self.operations.append(('remove_member', key, member))
+
+
+def from_url(url):
+    """Create a backend from an URL.
+
+    Supported are `redis://HOST:PORT/DB`, `sqlite:///PATH` (use four
+    slashes for absolute paths) and `memory://`."""
+    parsed = urlparse.urlparse(url)
+
+    if parsed.scheme == 'redis':
+        db = parsed.path.strip('/')
+        return RedisBackend(
+            host=parsed.hostname or 'localhost',
+            port=parsed.port or DEFAULT_REDIS_PORT,
+            db=int(db) if db else 0
+        )
+    elif parsed.scheme == 'sqlite':
+        if not parsed.path[1:]:
+            raise utils.HandledError("No database path in URL '{}'", url)
+        return SqliteBackend(parsed.path[1:])
+    elif parsed.scheme == 'memory':
+        return MemoryBackend()
+    else:
+        raise utils.HandledError("Unsupported database URL '{}'", url)
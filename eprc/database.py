@@ -1,32 +1,395 @@
-import redis
+import collections
+import itertools
 import json
+import threading
+import time
 
+import backends
+import records
 import utils
 
 
 class Database(object):
-    def __init__(self, host, port, db):
-        self.redis = redis.StrictRedis(host=host, port=port, db=db)
+    FAILURE_INDEX_KEY = "_failed"
+
+    # bump if existing databases need `migrate`
+    SCHEMA_KEY = "_schema"
+    SCHEMA_VERSION = 1
+
+    def __init__(self, backend):
+        self.backend = backend
+
+    @classmethod
+    def from_url(cls, url):
+        return cls(backends.from_url(url))
 
     @staticmethod
     def name_version_to_key(name, version):
         return "{}:{}".format(utils.normalize(name), utils.normalize(version))
 
-    def set(self, name, version, data):
-        self.redis.set(
-            self.name_version_to_key(name, version),
-            json.dumps(data)
-        )
+    @staticmethod
+    def name_to_index_key(name):
+        # normalized names never contain `_`, so this cannot clash with records
+        return "_versions:{}".format(utils.normalize(name))
 
-    def get(self, name, version):
-        string = self.redis.get(self.name_version_to_key(name, version))
+    @staticmethod
+    def _decode(string):
         if string:
-            return json.loads(string)
+            return records.decode(string)
         else:
             return None
 
+    def set(self, name, version, data):
+        self.set_many([(name, version, data)])
+
+    def set_many(self, items):
+        """Store multiple `(name, version, data)` records in one round trip."""
+        with self.backend.batch() as batch:
+            for name, version, data in items:
+                batch.set(
+                    self.name_version_to_key(name, version),
+                    records.encode(data)
+                )
+                batch.add_member(
+                    self.name_to_index_key(name),
+                    utils.normalize(version)
+                )
+
+    def get(self, name, version):
+        return self.get_many(name, [version])[0]
+
+    def get_many(self, name, versions):
+        """Get records for multiple versions of a package in one round trip.
+
+        Returns a list in the order of `versions`, missing records are
+        `None`."""
+        return [
+            self._decode(string)
+            for string in self.backend.get_many(
+                self.name_version_to_key(name, version)
+                for version in versions
+            )
+        ]
+
     def all_versions(self, name):
+        return list(self.backend.members(self.name_to_index_key(name)))
+
+    def all_records(self, name):
+        """Get all records of a package as `version -> data` dict."""
+        versions = self.all_versions(name)
+        return dict(
+            (version, data)
+            for version, data in zip(versions, self.get_many(name, versions))
+            if data
+        )
+
+    @staticmethod
+    def real_name_key(name):
+        return "_realname:{}".format(utils.normalize(name))
+
+    def get_real_name(self, name, max_age=None):
+        """Get the cached canonical PyPi name of a package, `None` if it is
+        unknown or older than `max_age` seconds."""
+        string = self.backend.get_many([self.real_name_key(name)])[0]
+        if not string:
+            return None
+
+        entry = json.loads(string)
+        if max_age is not None and time.time() - entry['timestamp'] > max_age:
+            return None
+        return entry['name']
+
+    def set_real_name(self, name, real_name):
+        with self.backend.batch() as batch:
+            batch.set(
+                self.real_name_key(name),
+                json.dumps({'name': real_name, 'timestamp': time.time()})
+            )
+
+    SOLUTION_PREFIX = "_solution:"
+    WARM_START_PREFIX = "_warmstart:"
+
+    @staticmethod
+    def _get_recent(string, max_age):
+        if not string:
+            return None
+
+        entry = json.loads(string)
+        if max_age is not None and time.time() - entry['timestamp'] > max_age:
+            return None
+        return entry
+
+    @classmethod
+    def solution_key(cls, digest):
+        return cls.SOLUTION_PREFIX + digest
+
+    def get_solution(self, digest, max_age=None):
+        """Get a cached solution (`packages` as `[name, version, extras]`
+        lists and `cost`) of the problem with the given digest, `None` if it
+        is unknown or older than `max_age` seconds."""
+        return self._get_recent(
+            self.backend.get_many([self.solution_key(digest)])[0],
+            max_age
+        )
+
+    def set_solution(self, digest, packages, cost):
+        with self.backend.batch() as batch:
+            batch.set(
+                self.solution_key(digest),
+                json.dumps({
+                    'packages': packages,
+                    'cost': cost,
+                    'timestamp': time.time()
+                })
+            )
+
+    @classmethod
+    def warm_start_key(cls, roots):
+        return cls.WARM_START_PREFIX + ",".join(sorted(roots))
+
+    def get_warm_start(self, roots, max_age=None):
+        """Get the last solution (`[name, version, extras]` lists) for a set
+        of root packages, `None` if there is none or if it is older than
+        `max_age` seconds."""
+        entry = self._get_recent(
+            self.backend.get_many([self.warm_start_key(roots)])[0],
+            max_age
+        )
+        if not entry:
+            return None
+        return entry['packages']
+
+    def set_warm_start(self, roots, packages):
+        with self.backend.batch() as batch:
+            batch.set(
+                self.warm_start_key(roots),
+                json.dumps({'packages': packages, 'timestamp': time.time()})
+            )
+
+    def clear_solutions(self, max_age=None, batch_size=1000):
+        """Forget cached solutions and warm starts (all or those older than
+        `max_age` seconds). Returns the number of removed entries."""
+        now = time.time()
+        count = 0
+        keys = self.backend.iter_keys(batch_size)
+        for chunk in iter(lambda: list(itertools.islice(keys, batch_size)), []):
+            chunk = [
+                key
+                for key in chunk
+                if key.startswith((self.SOLUTION_PREFIX, self.WARM_START_PREFIX))
+            ]
+            values = self.backend.get_many(chunk)
+
+            with self.backend.batch() as batch:
+                for key, string in zip(chunk, values):
+                    if not string:
+                        continue
+                    if max_age is not None and now - json.loads(string)['timestamp'] <= max_age:
+                        continue
+                    batch.delete(key)
+                    count += 1
+
+        return count
+
+    @staticmethod
+    def failure_key(name, version):
+        return "_failed:{}".format(Database.name_version_to_key(name, version))
+
+    def set_failure(self, name, version, reason):
+        """Remember that `name`:`version` cannot be extracted."""
+        with self.backend.batch() as batch:
+            batch.set(
+                self.failure_key(name, version),
+                json.dumps({'reason': reason, 'timestamp': time.time()})
+            )
+            batch.add_member(
+                self.FAILURE_INDEX_KEY,
+                self.name_version_to_key(name, version)
+            )
+
+    def get_failures(self, name, versions):
+        """Get failure entries (`reason` and `timestamp`) for multiple
+        versions of a package, `None` for versions without failures."""
         return [
-            key.split(":")[1]
-            for key in self.redis.keys("{}:*".format(utils.normalize(name)))
+            json.loads(string) if string else None
+            for string in self.backend.get_many(
+                self.failure_key(name, version)
+                for version in versions
+            )
         ]
+
+    def all_failures(self, name=None):
+        """Get `(name, version, entry)` for all recorded failures, optionally
+        limited to one package."""
+        keys = sorted(self.backend.members(self.FAILURE_INDEX_KEY))
+        if name:
+            prefix = "{}:".format(utils.normalize(name))
+            keys = [key for key in keys if key.startswith(prefix)]
+
+        name_versions = [key.split(":", 1) for key in keys]
+        result = []
+        for (name, version), string in zip(
+                name_versions,
+                self.backend.get_many(self.failure_key(name, version) for name, version in name_versions)):
+            if string:
+                result.append((name, version, json.loads(string)))
+        return result
+
+    def clear_failures(self, name=None):
+        """Forget recorded failures (of one package or all). Returns the
+        number of removed entries."""
+        failures = self.all_failures(name)
+        with self.backend.batch() as batch:
+            for name, version, _entry in failures:
+                batch.delete(self.failure_key(name, version))
+                batch.remove_member(
+                    self.FAILURE_INDEX_KEY,
+                    self.name_version_to_key(name, version)
+                )
+        return len(failures)
+
+    def check_schema(self):
+        """Raise `utils.HandledError` if the database contains records that
+        were written by an older eprc and `migrate` did not run yet. Empty
+        databases are marked as up to date."""
+        string = self.backend.get_many([self.SCHEMA_KEY])[0]
+        if string and int(string) >= self.SCHEMA_VERSION:
+            return
+
+        # records of older versions are not in the version index, so
+        # `all_records` would miss them
+        for key in self.backend.iter_keys():
+            if not key.startswith("_"):
+                raise utils.HandledError(
+                    "The database was written by an older version of eprc, "
+                    "run `eprc migrate` first"
+                )
+
+        with self.backend.batch() as batch:
+            batch.set(self.SCHEMA_KEY, str(self.SCHEMA_VERSION))
+
+    def migrate(self, batch_size=1000):
+        """Build the per-package version index from existing records and
+        convert JSON records to the compact format.
+
+        Returns the number of migrated records."""
+        count = 0
+        keys = self.backend.iter_keys(batch_size)
+        for chunk in iter(lambda: list(itertools.islice(keys, batch_size)), []):
+            chunk = [
+                key
+                for key in chunk
+                if ":" in key and not key.startswith("_")
+            ]
+            values = self.backend.get_many(chunk)
+
+            with self.backend.batch() as batch:
+                for key, string in zip(chunk, values):
+                    if not string:
+                        continue
+
+                    name, version = key.split(":", 1)
+                    batch.add_member(self.name_to_index_key(name), version)
+                    if records.is_legacy(string):
+                        batch.set(key, records.encode(records.decode(string)))
+                    count += 1
+
+        with self.backend.batch() as batch:
+            batch.set(self.SCHEMA_KEY, str(self.SCHEMA_VERSION))
+        return count
+
+
+class CachedDatabase(object):
+    """Read-through LRU cache for decoded records in front of a `Database`.
+
+    Holds at most `max_entries` records (including negative results). Writes
+    go to the database and update the cache. Cached records are shared, so
+    callers must not modify them. Everything not related to records is passed
+    to the wrapped database."""
+    _MISSING = object()
+
+    def __init__(self, db, max_entries=50000):
+        self.db = db
+        self.max_entries = max_entries
+        self.entries = collections.OrderedDict()  # (name, version) -> data
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __getattr__(self, attr):
+        return getattr(self.db, attr)
+
+    def __str__(self):
+        return "Record cache size={} hits={} misses={} evictions={}".format(
+            len(self.entries),
+            self.hits,
+            self.misses,
+            self.evictions
+        )
+
+    @staticmethod
+    def _key(name, version):
+        return (utils.normalize(name), utils.normalize(version))
+
+    def _lookup(self, key):
+        # needs lock
+        data = self.entries.pop(key, self._MISSING)
+        if data is self._MISSING:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self.entries[key] = data
+        return data
+
+    def _store(self, key, data):
+        # needs lock
+        self.entries.pop(key, None)
+        self.entries[key] = data
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def set(self, name, version, data):
+        self.set_many([(name, version, data)])
+
+    def set_many(self, items):
+        items = list(items)
+        self.db.set_many(items)
+        with self.lock:
+            for name, version, data in items:
+                self._store(self._key(name, version), data)
+
+    def get(self, name, version):
+        return self.get_many(name, [version])[0]
+
+    def get_many(self, name, versions):
+        versions = list(versions)
+        results = []
+        missing = []
+        with self.lock:
+            for version in versions:
+                data = self._lookup(self._key(name, version))
+                if data is self._MISSING:
+                    missing.append(version)
+                results.append(data)
+
+        if missing:
+            fetched = dict(zip(missing, self.db.get_many(name, missing)))
+            with self.lock:
+                for version, data in fetched.iteritems():
+                    self._store(self._key(name, version), data)
+            results = [
+                fetched[version] if data is self._MISSING else data
+                for version, data in zip(versions, results)
+            ]
+
+        return results
+
+    def all_records(self, name):
+        versions = self.all_versions(name)
+        return dict(
+            (version, data)
+            for version, data in zip(versions, self.get_many(name, versions))
+            if data
+        )
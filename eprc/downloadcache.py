@@ -0,0 +1,127 @@
+import hashlib
+import logging
+import os
+import os.path
+import tempfile
+import threading
+import urllib2
+
+import profiling
+
+
+class DownloadCache(object):
+    """Persistent on-disk cache for downloaded files.
+
+    Files are keyed by the SHA256 of their URL and streamed to disk in chunks,
+    so large archives never have to fit into memory. If `max_size` (in bytes)
+    is set, the least recently used files get evicted once the cache grows
+    beyond it."""
+    CHUNK_SIZE = 64 * 1024
+    TMP_PREFIX = ".tmp-"
+
+    # eviction makes room for further downloads, so the directory is not
+    # scanned again after every download once the cache is full
+    LOW_WATERMARK = 0.9
+
+    def __init__(self, path, max_size=None):
+        self.path = path
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.size = 0  # bytes, as of the last eviction plus new downloads
+
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+        if max_size is not None:
+            self._evict()
+
+    def _entry_path(self, url):
+        url = url.split('#')[0]
+        digest = hashlib.sha256(url).hexdigest()
+        return os.path.join(
+            self.path,
+            "{}-{}".format(digest, os.path.basename(url))
+        )
+
+    def _download(self, url, path, md5):
+        """Download `url` to `path` and return an open file object for it."""
+        fd, tmp_path = tempfile.mkstemp(prefix=self.TMP_PREFIX, dir=self.path)
+        try:
+            checksum = hashlib.md5()
+            with os.fdopen(fd, "wb") as outfile:
+                fp = urllib2.urlopen(url)
+                try:
+                    for chunk in iter(lambda: fp.read(self.CHUNK_SIZE), ''):
+                        outfile.write(chunk)
+                        checksum.update(chunk)
+                finally:
+                    fp.close()
+
+            if md5 and checksum.hexdigest() != md5.lower():
+                raise IOError("Checksum mismatch for {}".format(url))
+
+            # open before publishing, so it cannot get evicted in between
+            fp = open(tmp_path, "rb")
+            os.rename(tmp_path, path)
+            return fp
+        except:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def _evict(self):
+        # the directory is scanned, so files of other processes that share
+        # the cache are accounted for as well
+        entries = []
+        total = 0
+        for fname in os.listdir(self.path):
+            if fname.startswith(self.TMP_PREFIX):
+                continue
+            path = os.path.join(self.path, fname)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+            total += stat.st_size
+
+        if total <= self.max_size:
+            self.size = total
+            return
+
+        for _mtime, size, path in sorted(entries):
+            if total <= self.max_size * self.LOW_WATERMARK:
+                break
+            logging.debug("Evict {} from download cache".format(path))
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+        self.size = total
+
+    def open(self, url, md5=None):
+        """Return an open (binary) file object for the content of `url`.
+
+        The file is only downloaded if it is not cached yet. Because the file
+        is already open, it can be read even if it gets evicted meanwhile."""
+        path = self._entry_path(url)
+
+        try:
+            fp = open(path, "rb")
+            logging.debug("Use cached download for {}".format(url))
+
+            # mtime is used for LRU eviction
+            os.utime(path, None)
+            profiling.add("download.cached", 0.0)
+        except IOError:
+            with profiling.measure("download"):
+                fp = self._download(url, path, md5)
+
+            if self.max_size is not None:
+                with self.lock:
+                    self.size += os.fstat(fp.fileno()).st_size
+                    if self.size > self.max_size:
+                        self._evict()
+
+        return fp
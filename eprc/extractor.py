@@ -5,10 +5,15 @@ import pkg_resources
 import shutil
 import subprocess
 import tarfile
-import urllib2
+import tempfile
+import threading
 import zipfile
 
+from downloadcache import DownloadCache
+from forkserver import ExtractionTimeout, ForkServer, ForkServerError
+import profiling
 import utils
+from venvpool import VirtualenvPool
 
 
 class Extractor(object):
@@ -20,13 +25,50 @@ class Extractor(object):
             extractors_path=pkg_resources.resource_filename(
                 __name__,
                 "extractors"
-            )
+            ),
+            venv_pool_size=1,
+            fork_server=True,
+            extract_timeout=None,
+            download_cache=None
             ):
         self.extractor_setup_py = os.path.join(extractors_path, "setup_py.py")
         self.extractor_bundled = os.path.join(extractors_path, "bundled.py")
+        self.extractor_fork_server = os.path.join(extractors_path, "fork_server.py")
         self.virtualenv = virtualenv
         self.tmpdir = tmpdir
         self.pypi = pypi
+        self.venv_pool_size = venv_pool_size
+        self.venv_pools = {}  # tuple(packages) -> VirtualenvPool
+        self.venv_pools_lock = threading.Lock()
+        self.fork_server = fork_server
+        self.fork_servers = {}  # venvdir -> ForkServer
+        self.extract_timeout = extract_timeout
+
+        # without a persistent cache, only keep downloads for this session
+        if download_cache:
+            self.download_cache = download_cache
+        else:
+            self.download_cache = DownloadCache(
+                os.path.join(tmpdir, "downloads"),
+                max_size=0
+            )
+
+    def close(self):
+        for server in self.fork_servers.itervalues():
+            server.close()
+        self.fork_servers = {}
+
+    def _venv_pool(self, packages):
+        key = tuple(sorted(packages or []))
+        with self.venv_pools_lock:
+            if key not in self.venv_pools:
+                self.venv_pools[key] = VirtualenvPool(
+                    virtualenv=self.virtualenv,
+                    basedir=self.tmpdir,
+                    size=self.venv_pool_size,
+                    packages=key
+                )
+            return self.venv_pools[key]
 
     def _run_extractor(
             self,
@@ -37,62 +79,78 @@ class Extractor(object):
             packages=None):
         if not env:
             env = os.environ.copy()
-        extract_path = os.path.join(self.tmpdir, "extractor_result.json")
-        env['ILLUVATAR_EXTRACT_PATH'] = extract_path
 
-        # FIXME do not create a new venv all the time
-        # ideas:
-        #  - overlay fs
-        #  - clone (copy does not work, use virtualenv-clone)
-        #  - copy + `virtualenv --relocatable ENV`
-        #    (see https://pypi.python.org/pypi/virtualenv/1.3.1#making-environments-relocatable)
-        with open(os.devnull, "w") as fnull:
-            venvdir = os.path.join(self.tmpdir, "venv")
-            subprocess.check_call(
-                [self.virtualenv, venvdir],
-                stdout=fnull
-            )
-            pip = os.path.join(venvdir, "bin", "pip")
-
-            if packages:
-                args = [pip, "install"]
-                args.extend(packages)
-                subprocess.check_call(
-                    args,
-                    stdout=fnull
-                )
+        # every run gets its own scratch area, so multiple extractions can
+        # run concurrently
+        scratch = tempfile.mkdtemp(dir=self.tmpdir)
+        extract_path = os.path.join(scratch, "extractor_result.json")
+        env['ILLUVATAR_EXTRACT_PATH'] = extract_path
 
         try:
-            python = os.path.join(venvdir, "bin", "python")
+            with self._venv_pool(packages).acquire() as venvdir:
+                python = os.path.join(venvdir, "bin", "python")
 
-            what_to_call = [python, os.path.abspath(pyfile)]
-            if args:
-                what_to_call.extend(args)
+                what_to_call = [python, os.path.abspath(pyfile)]
+                if args:
+                    what_to_call.extend(args)
 
-            subprocess.check_call(
-                what_to_call,
-                cwd=cwd,
-                env=env
-            )
-            shutil.rmtree(venvdir)
+                with profiling.measure("extractor.run"):
+                    subprocess.check_call(
+                        what_to_call,
+                        cwd=cwd,
+                        env=env
+                    )
 
             with open(extract_path, 'r') as infile:
                 data = json.load(infile)
-            os.remove(extract_path)
 
             return data
         except subprocess.CalledProcessError:
             return None
+        finally:
+            shutil.rmtree(scratch)
+
+    def _run_fork_server(self, cwd, packages=None):
+        # `ForkServerError` and `ExtractionTimeout` are passed on, the
+        # extraction may succeed in a later run
+        with self._venv_pool(packages).acquire() as venvdir:
+            # venvs are used by one thread at a time,
+            # so is the fork server that belongs to it
+            server = self.fork_servers.get(venvdir)
+            if not server:
+                server = ForkServer(
+                    python=os.path.join(venvdir, "bin", "python"),
+                    server_path=os.path.abspath(self.extractor_fork_server)
+                )
+                self.fork_servers[venvdir] = server
+
+            try:
+                with profiling.measure("extractor.run"):
+                    return server.extract(
+                        os.path.abspath(cwd),
+                        timeout=self.extract_timeout
+                    )
+            except (ExtractionTimeout, ForkServerError):
+                # the venv gets replaced, so its server is not used again
+                del self.fork_servers[venvdir]
+                server.close()
+                raise
 
     def from_path(self, path, db, name=None, version=None):
         logging.debug("Extract from '{}'".format(path))
 
         # fire up setup_py.py
-        data = self._run_extractor(
-            pyfile=self.extractor_setup_py,
-            cwd=path,
-            packages=["mock"]
-        )
+        if self.fork_server:
+            data = self._run_fork_server(
+                cwd=path,
+                packages=["mock"]
+            )
+        else:
+            data = self._run_extractor(
+                pyfile=self.extractor_setup_py,
+                cwd=path,
+                packages=["mock"]
+            )
 
         if data:
             # try to fix some weird cases (e.g. numpy)
@@ -133,46 +191,45 @@ class Extractor(object):
 
         # find source package
         url = None
+        md5 = None
         for entry in self.pypi.release_urls(name, version):
             if entry['packagetype'] == 'sdist':
                 url = entry['url']
+                md5 = entry.get('md5_digest')
         if not url:
             logging.warn("No source URL found for {}:{}".format(name, version))
             return None
 
-        # download source package
-        archive_path = os.path.join(self.tmpdir, os.path.basename(url))
-        fp = urllib2.urlopen(url)
-        with open(archive_path, "wb") as archive_file:
-            archive_file.write(fp.read())
-
-        # extract archive
-        # FIXME be smarter and more secure about extraction
-        #       (paths, permissions, ...)
-        extracted_path = archive_path + ".extracted"
-        if archive_path.endswith("zip"):
-            with zipfile.ZipFile(archive_path, "r") as archive_file:
-                archive_file.extractall(extracted_path)
-        else:
-            with tarfile.open(archive_path, "r:gz") as archive_file:
-                archive_file.extractall(extracted_path)
-        os.remove(archive_path)
-
-        # extract dependency information
-        # FIXME be smarter about finding setup.py
-        target_path = os.path.join(
-            extracted_path,
-            os.listdir(extracted_path)[0]
-        )
-        data = self.from_path(
-            target_path,
-            db,
-            utils.normalize(name),
-            utils.normalize(version)
-        )
-        shutil.rmtree(extracted_path)
-
-        return data
+        # use a private scratch area, other versions might be processed
+        # concurrently
+        scratch = tempfile.mkdtemp(dir=self.tmpdir)
+        try:
+            # extract archive
+            # FIXME be smarter and more secure about extraction
+            #       (paths, permissions, ...)
+            extracted_path = os.path.join(scratch, "extracted")
+            with self.download_cache.open(url, md5) as fp, profiling.measure("unpack"):
+                if url.split('#')[0].endswith("zip"):
+                    with zipfile.ZipFile(fp, "r") as archive_file:
+                        archive_file.extractall(extracted_path)
+                else:
+                    with tarfile.open(fileobj=fp, mode="r:gz") as archive_file:
+                        archive_file.extractall(extracted_path)
+
+            # extract dependency information
+            # FIXME be smarter about finding setup.py
+            target_path = os.path.join(
+                extracted_path,
+                os.listdir(extracted_path)[0]
+            )
+            return self.from_path(
+                target_path,
+                db,
+                utils.normalize(name),
+                utils.normalize(version)
+            )
+        finally:
+            shutil.rmtree(scratch)
 
     def from_native(self, db, name):
         try:
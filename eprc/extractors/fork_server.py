@@ -0,0 +1,103 @@
+from __future__ import print_function
+
+import errno
+import json
+import os
+import select
+import signal
+import sys
+import time
+import traceback
+
+# preload everything the setup.py extractor needs,
+# forked children get it for free
+import setup_py
+
+
+def read_result(pid, fd, timeout):
+    chunks = []
+    deadline = None
+    if timeout:
+        deadline = time.time() + timeout
+
+    while True:
+        wait = None
+        if deadline:
+            wait = deadline - time.time()
+            if wait <= 0:
+                os.kill(pid, signal.SIGKILL)
+                return None, "timeout after {}s".format(timeout)
+
+        try:
+            ready, _, _ = select.select([fd], [], [], wait)
+        except select.error as e:
+            if e.args[0] == errno.EINTR:
+                continue
+            raise
+
+        if ready:
+            chunk = os.read(fd, 65536)
+            if not chunk:
+                return ''.join(chunks), None
+            chunks.append(chunk)
+
+
+def handle(request):
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+
+    if pid == 0:
+        # child: never return into the server loop
+        status = 1
+        try:
+            os.close(read_fd)
+            os.chdir(request['cwd'])
+            data = setup_py.extract()
+            with os.fdopen(write_fd, 'w') as outfile:
+                json.dump(data, outfile)
+            status = 0
+        except BaseException:
+            traceback.print_exc()
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os._exit(status)
+
+    os.close(write_fd)
+    try:
+        result, error = read_result(pid, read_fd, request.get('timeout'))
+    finally:
+        os.close(read_fd)
+    _, status = os.waitpid(pid, 0)
+
+    if error:
+        return {'ok': False, 'error': error, 'timeout': True}
+    elif status != 0:
+        return {'ok': False, 'error': "extractor failed with status {}".format(status)}
+    else:
+        return {'ok': True, 'data': json.loads(result)}
+
+
+def run():
+    # keep the protocol channels private, setup.py files tend to print a lot
+    # or even read from stdin
+    requests = os.fdopen(os.dup(0), 'r')
+    responses = os.fdopen(os.dup(1), 'w')
+    devnull = os.open(os.devnull, os.O_RDONLY)
+    os.dup2(devnull, 0)
+    os.close(devnull)
+    os.dup2(2, 1)
+
+    for line in iter(requests.readline, ''):
+        try:
+            response = handle(json.loads(line))
+        except Exception as e:
+            response = {'ok': False, 'error': str(e)}
+
+        responses.write(json.dumps(response))
+        responses.write("\n")
+        responses.flush()
+
+
+if __name__ == '__main__':
+    run()
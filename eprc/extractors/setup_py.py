@@ -74,7 +74,9 @@ def import_mock(name, *args, **kwargs):
         return MockedModule(name)
 
 
-def run():
+def extract():
+    """Run `setup.py` of the current working directory and return the
+    metadata that was passed to `setup()`."""
     argv = ['setup.py', 'install']
     sys.path.insert(0, os.getcwd())
 
@@ -107,6 +109,12 @@ def run():
         else:
             raise Exception("WTF?!")
 
+    return data
+
+
+def run():
+    data = extract()
+
     with open(os.getenv('ILLUVATAR_EXTRACT_PATH'), 'w') as outfile:
         json.dump(
             data,
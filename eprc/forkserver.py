@@ -0,0 +1,61 @@
+import json
+import logging
+import subprocess
+import threading
+
+
+class ForkServerError(Exception):
+    pass
+
+
+class ExtractionTimeout(Exception):
+    pass
+
+
+class ForkServer(object):
+    """Client for a long-lived `extractors/fork_server.py` process.
+
+    The server preloads all modules required by the setup.py extractor and
+    forks one child per request, so every extraction still starts from a
+    clean interpreter state. Results are returned over a pipe. A crashing
+    child only fails its own request."""
+    def __init__(self, python, server_path, env=None):
+        self.process = subprocess.Popen(
+            [python, server_path],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            env=env
+        )
+        self.lock = threading.Lock()
+
+    def extract(self, cwd, timeout=None):
+        with self.lock:
+            try:
+                self.process.stdin.write(json.dumps({
+                    'cwd': cwd,
+                    'timeout': timeout
+                }))
+                self.process.stdin.write("\n")
+                self.process.stdin.flush()
+                line = self.process.stdout.readline()
+            except IOError as e:
+                raise ForkServerError("Fork server is gone: {}".format(e))
+
+        if not line:
+            raise ForkServerError("Fork server is gone")
+
+        response = json.loads(line)
+        if response['ok']:
+            return response['data']
+        elif response.get('timeout'):
+            raise ExtractionTimeout("Extraction of '{}' failed: {}".format(cwd, response['error']))
+        else:
+            logging.debug("Extraction of '{}' failed: {}".format(cwd, response['error']))
+            return None
+
+    def close(self):
+        try:
+            self.process.stdin.close()
+        except IOError:
+            pass
+        self.process.wait()
@@ -0,0 +1,266 @@
+import collections
+import contextlib
+import json
+import logging
+import threading
+import time
+
+
+class Recorder(object):
+    """Collects counts and wall times of hot paths per phase and per package.
+
+    Events happen in the phase that is active (see `phase`) and belong to the
+    package that the current thread works on (see `package`)."""
+    def __init__(self):
+        self.start = time.time()
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.current_phase = "other"
+        self.phases = collections.OrderedDict()  # phase -> {'time': s, 'events': {category: stat}}
+        self.packages = {}   # package -> {category: stat}
+        self.instances = []  # solver instances, see `add_instance`
+        self.extra = {}      # section -> data, e.g. from tracemalloc
+
+    @staticmethod
+    def _update(events, category, elapsed, count):
+        stat = events.get(category)
+        if stat is None:
+            stat = events[category] = {'count': 0, 'time': 0.0}
+        stat['count'] += count
+        stat['time'] += elapsed
+
+    def _phase(self, name):
+        result = self.phases.get(name)
+        if result is None:
+            result = self.phases[name] = {'time': 0.0, 'events': {}}
+        return result
+
+    def add(self, category, elapsed, count=1):
+        package = getattr(self.local, 'package', None)
+        with self.lock:
+            self._update(self._phase(self.current_phase)['events'], category, elapsed, count)
+            if package:
+                self._update(self.packages.setdefault(package, {}), category, elapsed, count)
+
+    def add_phase_time(self, name, elapsed):
+        with self.lock:
+            self._phase(name)['time'] += elapsed
+
+    def add_instance(self, **info):
+        with self.lock:
+            self.instances.append(info)
+
+    def report(self):
+        with self.lock:
+            return {
+                'time': time.time() - self.start,
+                'phases': self.phases,
+                'packages': self.packages,
+                'instances': self.instances,
+                'extra': self.extra
+            }
+
+
+class _Measurement(object):
+    def __init__(self, recorder, category, count):
+        self.recorder = recorder
+        self.category = category
+        self.count = count
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.recorder.add(self.category, time.time() - self.start, self.count)
+
+
+class _NoMeasurement(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+
+_NO_MEASUREMENT = _NoMeasurement()
+
+# active recorder, `None` keeps the overhead of disabled profiling low
+_recorder = None
+
+
+def enable():
+    global _recorder
+    _recorder = Recorder()
+    return _recorder
+
+
+def disable():
+    global _recorder
+    _recorder = None
+
+
+def is_enabled():
+    return _recorder is not None
+
+
+def measure(category, count=1):
+    """Context manager that records one event (or `count` events) of
+    `category` with the wall time of the block."""
+    if _recorder is None:
+        return _NO_MEASUREMENT
+    return _Measurement(_recorder, category, count)
+
+
+def add(category, elapsed, count=1):
+    if _recorder is not None:
+        _recorder.add(category, elapsed, count)
+
+
+def add_instance(**info):
+    """Record the size and timings of a solver run."""
+    if _recorder is not None:
+        _recorder.add_instance(**info)
+
+
+@contextlib.contextmanager
+def phase(name):
+    """Attribute all events to phase `name` while the block runs. Phases are
+    not nested, the same phase can be entered multiple times."""
+    if _recorder is None:
+        yield
+        return
+
+    previous = _recorder.current_phase
+    _recorder.current_phase = name
+    start = time.time()
+    try:
+        yield
+    finally:
+        _recorder.add_phase_time(name, time.time() - start)
+        _recorder.current_phase = previous
+
+
+@contextlib.contextmanager
+def package(name):
+    """Attribute events of the current thread to package `name`."""
+    if _recorder is None:
+        yield
+        return
+
+    previous = getattr(_recorder.local, 'package', None)
+    _recorder.local.package = name
+    try:
+        yield
+    finally:
+        _recorder.local.package = previous
+
+
+class ProfiledBackend(object):
+    """Wraps a storage backend (see `backends`) and records its reads and
+    writes."""
+    def __init__(self, backend):
+        self.backend = backend
+
+    def get_many(self, keys):
+        keys = list(keys)
+        with measure("db.read", len(keys)):
+            return self.backend.get_many(keys)
+
+    def members(self, key):
+        with measure("db.read"):
+            return self.backend.members(key)
+
+    def iter_keys(self, batch_size=1000):
+        return self.backend.iter_keys(batch_size)
+
+    @contextlib.contextmanager
+    def batch(self):
+        start = time.time()
+        with self.backend.batch() as batch:
+            counting = _CountingBatch(batch)
+            yield counting
+        add("db.write", time.time() - start, counting.count)
+
+
+class _CountingBatch(object):
+    def __init__(self, batch):
+        self.batch = batch
+        self.count = 0
+
+    def set(self, key, value):
+        self.count += 1
+        self.batch.set(key, value)
+
+    def delete(self, key):
+        self.count += 1
+        self.batch.delete(key)
+
+    def add_member(self, key, member):
+        self.count += 1
+        self.batch.add_member(key, member)
+
+    def remove_member(self, key, member):
+        self.count += 1
+        self.batch.remove_member(key, member)
+
+
+@contextlib.contextmanager
+def cprofile(path):
+    """Run the block under cProfile and dump the statistics to `path`, e.g.
+    for `python -m pstats`. Only the calling thread is profiled."""
+    import cProfile
+
+    profile = cProfile.Profile()
+    profile.enable()
+    try:
+        yield
+    finally:
+        profile.disable()
+        profile.dump_stats(path)
+        logging.info("Wrote cProfile statistics to {}".format(path))
+
+
+@contextlib.contextmanager
+def trace_allocations(limit=25):
+    """Record the top allocation sites of the block in the report, if
+    `tracemalloc` is available (Python 3.4+ or the pytracemalloc backport)."""
+    try:
+        import tracemalloc
+    except ImportError:
+        logging.warn("tracemalloc is not available, allocations are not traced")
+        yield
+        return
+
+    tracemalloc.start()
+    try:
+        yield
+    finally:
+        snapshot = tracemalloc.take_snapshot()
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        if _recorder is not None:
+            _recorder.extra['tracemalloc'] = {
+                'current': current,
+                'peak': peak,
+                'top': [
+                    {'site': str(stat.traceback), 'size': stat.size, 'count': stat.count}
+                    for stat in snapshot.statistics('lineno')[:limit]
+                ]
+            }
+
+
+def write_report(path):
+    """Write everything recorded so far as JSON to `path`."""
+    if _recorder is None:
+        return
+
+    with open(path, 'w') as outfile:
+        json.dump(
+            _recorder.report(),
+            outfile,
+            sort_keys=True,
+            indent=4,
+            separators=(',', ': ')
+        )
+    logging.info("Wrote profile report to {}".format(path))
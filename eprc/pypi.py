@@ -1,36 +1,328 @@
-import urllib2
+import hashlib
+import itertools
+import json
+import logging
+import multiprocessing.pool
+import os
+import os.path
+import re
+import threading
+import urllib
+import urlparse
+import xmlrpclib
 
+from pip._vendor import requests
 import pip.download
 import pip.index
 
-import pkgtools.pypi
+import profiling
+import utils
+
+
+# listing of a local index, see `load_index`
+INDEX_FILENAME = "index.json"
+INDEX_FORMAT = 1
+
+SDIST_EXTENSIONS = ('.tar.gz', '.tgz', '.zip')
+WHEEL_EXTENSION = '.whl'
+
+# sdist names end at the first `-` that is followed by a digit,
+# versions may contain `-` themselves (e.g. `1.0.dev-1`)
+SDIST_NAME_VERSION = re.compile(r'^(.+?)-(\d.*)$')
+
+
+def _merge_releases(index, real_name, releases, has_sdist):
+    """Add `releases` (`{version: urls}`) of `real_name` to `index` (see
+    `load_index`). Spellings of the same project are merged, the spelling of
+    sdists wins."""
+    key = utils.normalize(real_name)
+    known_name, known_releases = index.get(key, (real_name, {}))
+    if has_sdist and key in index and known_name != real_name:
+        logging.debug("Merge {} into {} in local index".format(known_name, real_name))
+        known_name = real_name
+
+    for version, urls in releases.iteritems():
+        known_version, known_urls = known_releases.get(utils.normalize(version), (version, []))
+        known_releases[utils.normalize(version)] = (known_version, known_urls + urls)
+    index[key] = (known_name, known_releases)
+
+
+def load_index(location):
+    """Load the listing of a local index.
+
+    `location` is a directory that contains an `index.json`, the JSON file
+    itself or a file:// URL of one of them. The listing maps real package
+    names to versions and their release URLs, in the format of the
+    `release_urls` XML-RPC call. Relative URLs are relative to the listing.
+
+    Returns `normalized name -> (real name, {normalized version: (version,
+    urls)})`."""
+    parsed = urlparse.urlparse(location)
+    if parsed.scheme == 'file':
+        path = urllib.url2pathname(parsed.path)
+    else:
+        path = location
+    if os.path.isdir(path):
+        path = os.path.join(path, INDEX_FILENAME)
+
+    try:
+        with open(path, 'r') as infile:
+            listing = json.load(infile)
+    except (IOError, ValueError) as e:
+        raise utils.HandledError("Cannot read local index '{}': {}", path, e)
+    if listing.get('format') != INDEX_FORMAT:
+        raise utils.HandledError("Unknown format of local index '{}'", path)
+
+    base = 'file://' + urllib.pathname2url(os.path.dirname(os.path.abspath(path))) + '/'
+    index = {}
+    for real_name, releases in sorted(listing['packages'].iteritems()):
+        releases = dict(
+            (version, [
+                dict(entry, url=urlparse.urljoin(base, entry['url']))
+                for entry in urls
+            ])
+            for version, urls in releases.iteritems()
+        )
+        has_sdist = any(
+            entry.get('packagetype') == 'sdist'
+            for urls in releases.itervalues()
+            for entry in urls
+        )
+        _merge_releases(index, real_name, releases, has_sdist)
+    return index
+
+
+def _parse_filename(filename):
+    """Get `(name, version, packagetype)` of a distribution file or `None`."""
+    if filename.endswith(WHEEL_EXTENSION):
+        parts = filename[:-len(WHEEL_EXTENSION)].split('-')
+        if len(parts) >= 5:
+            return parts[0], parts[1], 'bdist_wheel'
+    for extension in SDIST_EXTENSIONS:
+        if filename.endswith(extension):
+            match = SDIST_NAME_VERSION.match(filename[:-len(extension)])
+            if match:
+                return match.group(1), match.group(2), 'sdist'
+    return None
+
+
+def build_index(directory):
+    """Write the listing of all sdists and wheels below `directory` (e.g. a
+    wheelhouse) to `directory/index.json`. Returns the number of files.
+
+    Files of the same project are listed under one name, even if sdists and
+    wheels spell it differently (e.g. `Foo-Bar` and `Foo_Bar`)."""
+    packages = {}  # normalized name -> (real name, {version: [release url]})
+    sdist_names = {}  # normalized name -> real name used by sdists
+    count = 0
+    for dirpath, dirnames, filenames in os.walk(directory):
+        dirnames.sort()
+        for filename in sorted(filenames):
+            parsed = _parse_filename(filename)
+            if not parsed:
+                continue
+            name, version, packagetype = parsed
+
+            path = os.path.join(dirpath, filename)
+            md5 = hashlib.md5()
+            with open(path, 'rb') as infile:
+                for chunk in iter(lambda: infile.read(64 * 1024), ''):
+                    md5.update(chunk)
+
+            key = utils.normalize(name)
+            if packagetype == 'sdist':
+                sdist_names.setdefault(key, name)
+            _real_name, releases = packages.setdefault(key, (name, {}))
+
+            # different spellings of the same version share one entry
+            version = next(
+                (known for known in releases if utils.normalize(known) == utils.normalize(version)),
+                version
+            )
+            releases.setdefault(version, []).append({
+                'filename': filename,
+                'packagetype': packagetype,
+                'md5_digest': md5.hexdigest(),
+                'url': urllib.pathname2url(os.path.relpath(path, directory))
+            })
+            count += 1
+
+    listing = dict(
+        (sdist_names.get(key, real_name), releases)
+        for key, (real_name, releases) in packages.iteritems()
+    )
+    with open(os.path.join(directory, INDEX_FILENAME), 'w') as outfile:
+        json.dump(
+            {'format': INDEX_FORMAT, 'packages': listing},
+            outfile,
+            sort_keys=True,
+            indent=4,
+            separators=(',', ': ')
+        )
+    return count
 
 
 class PyPi(object):
-    def __init__(self):
-        self.pypi = pkgtools.pypi.PyPIXmlRpc()
+    """Access to package names, versions and release URLs.
+
+    Uses PyPi by default. If `index` (see `load_index`) is given, everything
+    is looked up in that local index instead and no network access is
+    needed (except for remote URLs in the listing)."""
+    XMLRPC_URL = 'https://pypi.python.org/pypi'
+
+    # number of calls per XML-RPC multicall request
+    MULTICALL_SIZE = 100
+
+    def __init__(self, db=None, real_name_ttl=None, concurrency=8, index=None):
+        self.index = load_index(index) if index else None
+        self.db = db
+        self.real_name_ttl = real_name_ttl
+        self.real_names = {}  # normalized name -> real name
+        self.release_urls_cache = {}  # (name, version) -> urls
+        self.local = threading.local()
+        self.pool = multiprocessing.pool.ThreadPool(concurrency)
+
+        # one session for all HTTP requests, so connections are kept alive
+        self.session = pip.download.PipSession()
         self.pip_packagefinder = pip.index.PackageFinder(
             find_links=[],
             index_urls=['https://pypi.python.org/simple'],
-            session=pip.download.PipSession()
+            session=self.session
         )
 
+    def close(self):
+        if self.pool:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+    def _xmlrpc(self):
+        # proxies are not thread-safe, but keep their connection alive,
+        # so use one per thread
+        proxy = getattr(self.local, 'proxy', None)
+        if proxy is None:
+            proxy = xmlrpclib.ServerProxy(self.XMLRPC_URL)
+            self.local.proxy = proxy
+        return proxy
+
     def package_releases(self, name):
         """Use weird PIP system instead of the official PyPi API.
 
         They sometimes provide different results. But because eprc is intended
         to be used with PIP, we accept this buggy system here."""
+        if self.index is not None:
+            _real_name, releases = self.index.get(utils.normalize(name), (None, {}))
+            return [version for version, _urls in releases.itervalues()]
+
         return list(set(
             str(candidate.version)
             for candidate in self.pip_packagefinder._find_all_versions(name)
         ))
 
+    def _lookup(self, name):
+        if self.index is not None:
+            if utils.normalize(name) not in self.index:
+                logging.debug("{} is not in the local index".format(name))
+                return None
+            real_name = self.real_name(name)
+            return (real_name, self.package_releases(real_name))
+
+        with profiling.package(utils.normalize(name)), profiling.measure("pypi.lookup"):
+            try:
+                real_name = self.real_name(name)
+            except requests.HTTPError as e:
+                logging.debug("Cannot resolve {}: {}".format(name, e))
+                return None
+
+            return (real_name, self.package_releases(real_name))
+
+    def lookup_many(self, names):
+        """Resolve real names and releases of multiple packages concurrently.
+
+        Returns a list of `(real_name, versions)` tuples in the order of
+        `names`, `None` for packages that cannot be resolved."""
+        return utils.pool_map(self.pool, self._lookup, names)
+
+    def _release_urls_chunk(self, chunk):
+        name, versions = chunk
+        multicall = xmlrpclib.MultiCall(self._xmlrpc())
+        for version in versions:
+            multicall.release_urls(name, version)
+
+        try:
+            with profiling.package(utils.normalize(name)), \
+                    profiling.measure("pypi.release_urls", len(versions)):
+                results = multicall()
+        except (IOError, xmlrpclib.Error) as e:
+            # release_urls falls back to single requests
+            logging.debug("Multicall for {} failed: {}".format(name, e))
+            return
+
+        for i, version in enumerate(versions):
+            try:
+                urls = results[i]
+            except xmlrpclib.Fault as e:
+                logging.debug("Cannot get URLs for {}:{}: {}".format(name, version, e))
+                continue
+            self.release_urls_cache[(utils.normalize(name), utils.normalize(version))] = urls
+
+    def prefetch_release_urls(self, jobs):
+        """Fetch release URLs for multiple `(name, version)` tuples.
+
+        Versions of the same package are batched into multicall requests,
+        which run concurrently. Results are consumed by `release_urls`."""
+        if self.index is not None:
+            return
+
+        chunks = []
+        for name, group in itertools.groupby(sorted(jobs), lambda job: job[0]):
+            versions = [version for _name, version in group]
+            for i in xrange(0, len(versions), self.MULTICALL_SIZE):
+                chunks.append((name, versions[i:i + self.MULTICALL_SIZE]))
+
+        utils.pool_map(self.pool, self._release_urls_chunk, chunks)
+
     def release_urls(self, name, version):
-        return self.pypi.release_urls(name, version)
+        if self.index is not None:
+            _real_name, releases = self.index.get(utils.normalize(name), (None, {}))
+            return releases.get(utils.normalize(version), (None, []))[1]
+
+        urls = self.release_urls_cache.pop(
+            (utils.normalize(name), utils.normalize(version)),
+            None
+        )
+        if urls is None:
+            with profiling.measure("pypi.release_urls"):
+                urls = self._xmlrpc().release_urls(name, version)
+        return urls
 
     def real_name(self, package_name, timeout=None):
-        """Replaces buggy pkgtools.pypi.real_name."""
-        r = urllib2.Request(
-            'http://pypi.python.org/pypi/{0}'.format(package_name)
+        """Replaces buggy pkgtools.pypi.real_name.
+
+        Results are memoized and, if a database is set, persisted for
+        `real_name_ttl` seconds."""
+        key = utils.normalize(package_name)
+        if self.index is not None:
+            return self.index.get(key, (package_name, None))[0]
+
+        result = self.real_names.get(key)
+        if result:
+            return result
+
+        if self.db:
+            result = self.db.get_real_name(key, self.real_name_ttl)
+        if not result:
+            result = self._fetch_real_name(package_name, timeout)
+            if self.db:
+                self.db.set_real_name(key, result)
+
+        self.real_names[key] = result
+        return result
+
+    def _fetch_real_name(self, package_name, timeout=None):
+        response = self.session.get(
+            'http://pypi.python.org/pypi/{0}'.format(package_name),
+            timeout=timeout
         )
-        return urllib2.urlopen(r, timeout=timeout).geturl().split('/')[-1]
+        response.raise_for_status()
+        return response.url.rstrip('/').split('/')[-1]
@@ -0,0 +1,167 @@
+import json
+import pkg_resources
+
+import profiling
+
+
+# compact records start with this, JSON records never do
+MAGIC = "\x00eprc"
+FORMAT_VERSION = 3
+
+REQUIREMENT_FIELDS = ['setup_requires', 'install_requires', 'tests_require']
+
+# both caches are dropped when they get too large
+REQUIREMENT_CACHE_SIZE = 10000
+_requirement_cache = {}  # (name, specs, extras) -> pkg_resources.Requirement
+_decoded_cache = {}      # encoded requirement -> _RequirementData
+
+
+class _RequirementData(dict):
+    """Requirement of a decoded record. Keeps the packed form and the parsed
+    `pkg_resources.Requirement`. Equal requirements of different records
+    share one instance."""
+    __slots__ = ('packed', 'parsed')
+
+    def __init__(self, packed):
+        name, specs, extras = packed
+        super(_RequirementData, self).__init__(
+            name=name,
+            extras=list(extras),
+            specs=[{'op': op, 'version': version} for op, version in specs]
+        )
+        self.packed = packed
+        self.parsed = None
+
+
+def _pack_requirement(requ_data):
+    # same layout as the arguments of pkg_resources.Requirement
+    return (
+        requ_data['name'],
+        tuple((spec['op'], spec['version']) for spec in requ_data['specs']),
+        tuple(requ_data['extras'])
+    )
+
+
+def _encode_requirement(requ_data):
+    # e.g. `requests [security] >= 2.0 < 3`, none of the parts can contain
+    # whitespace
+    parts = [requ_data['name']]
+    if requ_data['extras']:
+        parts.append("[" + ",".join(requ_data['extras']) + "]")
+    for spec in requ_data['specs']:
+        parts.append(spec['op'])
+        parts.append(spec['version'])
+    return " ".join(parts)
+
+
+def _decode_requirement(string):
+    result = _decoded_cache.get(string)
+    if result is None:
+        parts = string.split(" ")
+        extras = ()
+        if len(parts) > 1 and parts[1].startswith("["):
+            extras = tuple(parts[1][1:-1].split(","))
+            del parts[1]
+        result = _RequirementData((
+            parts[0],
+            tuple(zip(parts[1::2], parts[2::2])),
+            extras
+        ))
+        if len(_decoded_cache) >= REQUIREMENT_CACHE_SIZE:
+            _decoded_cache.clear()
+        _decoded_cache[string] = result
+    return result
+
+
+def encode(data):
+    """Encode a metadata record to the compact format: a header and a JSON
+    array without any keys.
+
+    Every requirement is stored as a single string. Records usually share
+    most of their requirements (e.g. different versions of a package), so
+    `decode` only has to build the decoded form of new strings."""
+    payload = (
+        data['name'],
+        data['version'],
+        tuple(
+            tuple(_encode_requirement(r) for r in data[field])
+            for field in REQUIREMENT_FIELDS
+        ),
+        tuple(sorted(
+            (extra, tuple(_encode_requirement(r) for r in requirements))
+            for extra, requirements in data['extras_require'].iteritems()
+        ))
+    )
+    return MAGIC + chr(FORMAT_VERSION) + json.dumps(payload, separators=(',', ':'))
+
+
+def decode(string):
+    """Decode a compact or (legacy) JSON record."""
+    if not string.startswith(MAGIC):
+        with profiling.measure("records.decode_json"):
+            return json.loads(string)
+
+    with profiling.measure("records.decode"):
+        return _decode_compact(string)
+
+
+def _decode_compact(string):
+    version = ord(string[len(MAGIC)])
+    if version != FORMAT_VERSION:
+        raise ValueError("Unknown record format version {}".format(version))
+
+    name, version, requirements, extras = json.loads(string[len(MAGIC) + 1:])
+    data = {
+        'name': name,
+        'version': version,
+        'extras_require': dict(
+            (extra, [_decode_requirement(r) for r in encoded])
+            for extra, encoded in extras
+        )
+    }
+    for field, encoded in zip(REQUIREMENT_FIELDS, requirements):
+        data[field] = [_decode_requirement(r) for r in encoded]
+
+    return data
+
+
+def is_legacy(string):
+    return not string.startswith(MAGIC)
+
+
+def requirement(requ_data):
+    """Get the (memoized) `pkg_resources.Requirement` for a requirement of a
+    record."""
+    if isinstance(requ_data, _RequirementData):
+        if requ_data.parsed is None:
+            requ_data.parsed = _parse_requirement(requ_data.packed)
+        return requ_data.parsed
+
+    key = _pack_requirement(requ_data)
+    result = _requirement_cache.get(key)
+    if result is None:
+        result = _parse_requirement(key)
+        if len(_requirement_cache) >= REQUIREMENT_CACHE_SIZE:
+            _requirement_cache.clear()
+        _requirement_cache[key] = result
+    return result
+
+
+def _parse_requirement(key):
+    # official version:
+    #
+    #     requirement_string = "{}".format(requ_data['name'])
+    #     if requ_data['specs']:
+    #         requirement_string += ','.join("{}{}".format(spec["op"], spec["version"]) for spec in requ_data['specs'])
+    #     requirement = pkg_resources.Requirement.parse(requirement_string)
+    #
+    # but that is too slow, so use the undocumented API if available
+    try:
+        return pkg_resources.Requirement(*key)
+    except TypeError:
+        name, specs, extras = key
+        requirement_string = name
+        if extras:
+            requirement_string += "[" + ",".join(extras) + "]"
+        requirement_string += ",".join(op + version for op, version in specs)
+        return pkg_resources.Requirement.parse(requirement_string)
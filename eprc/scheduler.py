@@ -1,11 +1,29 @@
 import itertools
 import logging
-import urllib2
+import multiprocessing.pool
+import pkg_resources
+import time
 
+from forkserver import ExtractionTimeout, ForkServerError
+import profiling
+import records
+import solver
 import utils
+from venvpool import VirtualenvError
+
+
+# failures that are remembered across runs (e.g. no sdist, broken setup.py)
+PERMANENT_FAILURE = "permanent"
+
+# failures that only blacklist the version for the current run (network
+# errors, timeouts, problems of the local environment like missing
+# binaries, broken virtualenvs or lost fork servers)
+TRANSIENT_FAILURE = "transient"
+TRANSIENT_ERRORS = (EnvironmentError, ExtractionTimeout, ForkServerError, VirtualenvError)
+
 
 class Scheduler(object):
-    def __init__(self, db, extractor, pypi, verbosity=1):
+    def __init__(self, db, extractor, pypi, verbosity=1, jobs=1, retry_failed_after=None, lazy_batch=None):
         self.db = db
         self.extractor = extractor
         self.pypi = pypi
@@ -14,6 +32,27 @@ class Scheduler(object):
         self.blacklist = set()
         self.report_counter = 0
         self.verbosity = verbosity
+        self.jobs = jobs
+        self.retry_failed_after = retry_failed_after
+
+        # all releases of processed packages
+        self.releases = {}  # name -> versions
+
+        # lazy mode: only extract the newest `lazy_batch` versions at first
+        self.lazy_batch = lazy_batch
+        self.pending = {}   # name -> [(real name, version)], newest first
+
+        # versions that do not satisfy any known requirement
+        self.requirements = {}  # name -> set(pkg_resources.Requirement)
+        self.skipped = {}       # name -> [(real name, version)]
+        self.requeued = []      # [(real name, version)]
+
+        # extraction is done by subprocesses and network I/O,
+        # so threads are enough to keep multiple cores busy
+        if jobs > 1:
+            self.pool = multiprocessing.pool.ThreadPool(jobs)
+        else:
+            self.pool = None
 
     def __str__(self):
         return "Scheduler done={} todo={} blacklisted={}".format(
@@ -22,12 +61,22 @@ class Scheduler(object):
             len(self.blacklist)
         )
 
-    def get(self):
+    def close(self):
+        if self.pool:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+    def _pop(self):
         entry = None
         while self.todo and not entry:
             candidate = self.todo.pop()
             if candidate not in self.done:
                 entry = candidate
+        return entry
+
+    def get(self):
+        entry = self._pop()
 
         self.report_counter += 1
         if self.report_counter >= self.verbosity:
@@ -36,15 +85,27 @@ class Scheduler(object):
 
         return entry
 
+    def get_many(self, n):
+        entries = []
+        entry = self.get()
+        while entry:
+            entries.append(entry)
+            if len(entries) >= n:
+                break
+            entry = self._pop()
+        return entries
+
     def add_todos_from_db(self, name, version, extra=''):
+        self.add_todos_from_data(self.db.get(name, version), extra)
+
+    def add_todos_from_data(self, data, extra=''):
         def add_to_todo(pkg):
+            self.add_requirement(pkg)
             for extra_wish in itertools.chain([''], pkg['extras']):
                 candidate = (utils.normalize(pkg['name']), utils.normalize(extra_wish))
                 if candidate not in self.done:
                     self.todo.add(candidate)
 
-        data = self.db.get(name, version)
-
         # always add the defaults (without extras)
         for pkg in itertools.chain(
                 data['setup_requires'],
@@ -56,71 +117,322 @@ class Scheduler(object):
             for pkg in data['extras_require'].get(extra, []):
                 add_to_todo(pkg)
 
+    def add_requirement(self, requ_data):
+        """Remember a requirement, so versions that cannot satisfy any known
+        requirement are not extracted. Versions skipped earlier that satisfy
+        this requirement get scheduled again."""
+        key = utils.normalize(requ_data['name'])
+        requirement = records.requirement(requ_data)
+        known = self.requirements.setdefault(key, set())
+        if requirement in known:
+            return
+        known.add(requirement)
+
+        skipped = self.skipped.get(key)
+        if not skipped:
+            return
+
+        accepted = [
+            job
+            for job in skipped
+            if pkg_resources.parse_version(job[1]) in requirement
+        ]
+        if accepted:
+            self.skipped[key] = [job for job in skipped if job not in accepted]
+            if self.lazy_batch:
+                self.pending[key] = sorted(
+                    self.pending.get(key, []) + accepted,
+                    key=lambda (_name, version): pkg_resources.parse_version(version),
+                    reverse=True
+                )
+            else:
+                self.requeued.extend(accepted)
+
+    def is_version_acceptable(self, name, version):
+        requirements = self.requirements.get(utils.normalize(name))
+        if not requirements:
+            return True
+
+        version = pkg_resources.parse_version(version)
+        return any(version in requirement for requirement in requirements)
+
     def done_with_all_versions(self, name, extra):
         self.done.add((utils.normalize(name), utils.normalize(extra)))
 
-    def blacklist_version(self, name, version):
+    def blacklist_version(self, name, version, reason=None, kind=PERMANENT_FAILURE):
         self.blacklist.add((utils.normalize(name), utils.normalize(version)))
+        if reason and kind == PERMANENT_FAILURE:
+            self.db.set_failure(name, version, reason)
 
     def is_version_blacklisted(self, name, version):
         return (utils.normalize(name), utils.normalize(version)) in self.blacklist
 
+    def load_failures(self, name, versions):
+        """Blacklist versions that failed in earlier runs and are not due for
+        a retry yet."""
+        now = time.time()
+        for version, entry in zip(versions, self.db.get_failures(name, versions)):
+            if not entry:
+                continue
+            if self.retry_failed_after is not None \
+                    and now - entry['timestamp'] > self.retry_failed_after:
+                continue
+            self.blacklist_version(name, version)
+
     def process_cached(self, name, extra):
-        all_versions = self.db.all_versions(name)
-        if not all_versions:
+        all_records = self.db.all_records(name)
+        if not all_records:
             logging.warn("No versions found for {}".format(name))
 
-        for version in all_versions:
-            self.add_todos_from_db(name, version, extra)
+        for data in all_records.itervalues():
+            self.add_todos_from_data(data, extra)
 
         self.done_with_all_versions(name, extra)
 
     def process_extract(self, name, extra):
-        native_result = self.extractor.from_native(self.db, name)
+        self.process_extract_many([(name, extra)])
 
-        try:
-            name = self.pypi.real_name(name)
-        except urllib2.HTTPError:
-            logging.warning("PyPi error for {}".format(name))
-            return
+    def _from_native(self, todo):
+        name, _extra = todo
+        return self.extractor.from_native(self.db, name)
 
-        versions = self.pypi.package_releases(name)
-        if not versions and not native_result:
-            logging.warn("No versions found for {}".format(name))
-            return
+    def _extract(self, job):
+        name, version = job
+        with profiling.package(utils.normalize(name)), profiling.measure("extract"):
+            return self._extract_job(name, version)
 
-        for version in versions:
-            data = self.db.get(name, version)
+    def _extract_job(self, name, version):
+        """Extract one version. Returns `None` on success, `(kind, reason)`
+        otherwise, see `PERMANENT_FAILURE` and `TRANSIENT_FAILURE`."""
+        try:
+            logging.info(
+                "Fetching {}:{}".format(
+                    utils.normalize(name),
+                    utils.normalize(version)
+                )
+            )
+            data = self.extractor.from_pypi(self.db, name, version)
+
+            # did we get something useful?
             if data:
-                logging.info("Cached {}:{}".format(utils.normalize(name), utils.normalize(version)))
-            elif self.is_version_blacklisted(name, version):
-                logging.info("Blacklisted {}:{}".format(name, version))
+                return None
             else:
-                try:
-                    logging.info(
-                        "Fetching {}:{}".format(
-                            utils.normalize(name),
-                            utils.normalize(version)
-                        )
-                    )
-                    data = self.extractor.from_pypi(self.db, name, version)
-
-                    # did we get something useful?
-                    if not data:
-                        self.blacklist_version(name, version)
-                except Exception as e:
-                    logging.warn(
-                        "Unhandled exception while processing {}:{} - {}".format(
-                            name,
-                            version,
-                            e
-                        )
-                    )
-                    self.blacklist_version(name, version)
-
-            # register
+                return PERMANENT_FAILURE, "no metadata (missing sdist or extractor failed)"
+        except TRANSIENT_ERRORS as e:
+            logging.warn(
+                "Temporary failure while processing {}:{} - {}".format(
+                    name,
+                    version,
+                    e
+                )
+            )
+            return TRANSIENT_FAILURE, "exception: {}".format(e)
+        except Exception as e:
+            logging.warn(
+                "Unhandled exception while processing {}:{} - {}".format(
+                    name,
+                    version,
+                    e
+                )
+            )
+            return PERMANENT_FAILURE, "exception: {}".format(e)
+
+    def _select_candidates(self, name, versions, candidates, has_records):
+        """Select the versions that should be extracted now.
+
+        Versions that cannot satisfy any known requirement are skipped. In
+        lazy mode, only the `lazy_batch` newest candidates are used, the rest
+        is kept for `expand`."""
+        key = utils.normalize(name)
+        if key in self.releases:
+            # already handled by a todo with another extra
+            return []
+        self.releases[key] = [utils.normalize(version) for version in versions]
+
+        accepted = []
+        skipped = []
+        for job in candidates:
+            if self.is_version_acceptable(*job):
+                accepted.append(job)
+            else:
+                skipped.append(job)
+
+        # keep at least one real version, otherwise the package would be
+        # treated as virtual package that satisfies every requirement
+        if skipped and not accepted and not has_records:
+            newest = max(
+                skipped,
+                key=lambda (_name, version): pkg_resources.parse_version(version)
+            )
+            skipped.remove(newest)
+            accepted.append(newest)
+
+        if skipped:
+            logging.info("Skip {} versions of {} that no requirement accepts".format(
+                len(skipped),
+                key
+            ))
+            self.skipped[key] = skipped
+
+        if not self.lazy_batch:
+            return accepted
+
+        self.pending[key] = sorted(
+            accepted,
+            key=lambda (_name, version): pkg_resources.parse_version(version),
+            reverse=True
+        )
+        return self._next_pending(key)
+
+    def _next_pending(self, name):
+        key = utils.normalize(name)
+        pending = self.pending.get(key, [])
+        self.pending[key] = pending[self.lazy_batch:]
+        return pending[:self.lazy_batch]
+
+    def _run_jobs(self, jobs):
+        """Extract `(name, version)` jobs and return all jobs that were
+        processed.
+
+        In lazy mode, older versions are extracted for every package until it
+        has at least one usable version or there are no versions left."""
+        done = []
+        while jobs:
+            self.pypi.prefetch_release_urls(jobs)
+            for (name, version), error in zip(jobs, utils.pool_map(self.pool, self._extract, jobs)):
+                if error:
+                    kind, reason = error
+                    self.blacklist_version(name, version, reason, kind)
+            done.extend(jobs)
+
+            retry = []
+            if self.lazy_batch:
+                for name in sorted(set(name for name, _version in jobs)):
+                    if not self.db.all_versions(name):
+                        retry.extend(self._next_pending(name))
+            jobs = retry
+
+        return done
+
+    def expansion_candidates(self, solution):
+        """Get packages whose pending (older) versions could lead to a better
+        solution than `solution` (lazy mode).
+
+        Every solution that uses a pending version costs at least the weight
+        of that version, so if no pending version is cheaper than the current
+        optimum, the optimum is proven. Without solution, all packages with
+        pending versions are candidates."""
+        result = []
+        for name, pending in sorted(self.pending.iteritems()):
+            if not pending:
+                continue
+
+            if solution is None:
+                result.append(name)
+            else:
+                weights = solver.version_weights(self.releases[name])
+                best = min(
+                    weights[pkg_resources.parse_version(utils.normalize(version))]
+                    for _name, version in pending
+                )
+                if best < solution.cost:
+                    result.append(name)
+
+        return result
+
+    def expand(self, names):
+        """Extract the next batch of older versions of `names` (lazy mode) and
+        schedule their requirements for all extras processed so far.
+
+        Returns `False` if there was nothing left to extract."""
+        jobs = []
+        for name in names:
+            jobs.extend(self._next_pending(name))
+        if not jobs:
+            return False
+
+        self._register_new_versions(self._run_jobs(jobs))
+        self._process_requeued()
+        return True
+
+    def _register_new_versions(self, jobs):
+        """Schedule requirements of newly extracted versions for all extras
+        processed so far."""
+        extras = {}  # name -> set(extra)
+        for name, extra in self.done:
+            extras.setdefault(name, set()).add(extra)
+
+        for name, version in jobs:
             data = self.db.get(name, version)
             if data:
-                self.add_todos_from_db(data['name'], data['version'], extra)
+                for extra in sorted(extras.get(utils.normalize(name), [''])):
+                    self.add_todos_from_data(data, extra)
 
-        self.done_with_all_versions(name, extra)
+    def _process_requeued(self):
+        while self.requeued:
+            jobs = self.requeued
+            self.requeued = []
+            self._register_new_versions(self._run_jobs(jobs))
+
+    def process_extract_many(self, todos):
+        """Extract all versions of multiple packages.
+
+        Packages and their versions are processed by the worker pool (if
+        `jobs` > 1). The results are fed back to the todo set in the order of
+        `todos` and (sorted) versions, so the outcome does not depend on the
+        order in which workers finish."""
+        natives = utils.pool_map(self.pool, self._from_native, todos)
+        lookups = self.pypi.lookup_many([name for name, _extra in todos])
+
+        resolved = []
+        for (name, extra), native_result, lookup in zip(todos, natives, lookups):
+            if not lookup:
+                logging.warning("PyPi error for {}".format(name))
+                continue
+
+            name, versions = lookup
+            if not versions and not native_result:
+                logging.warn("No versions found for {}".format(name))
+                continue
+
+            resolved.append((name, extra, sorted(versions)))
+
+        # figure out what needs to be fetched,
+        # the same package might be requested with different extras
+        jobs = []
+        seen = set()
+        for name, extra, versions in resolved:
+            self.load_failures(name, versions)
+            cached = self.db.get_many(name, versions)
+            candidates = []
+            for version, data in zip(versions, cached):
+                key = (utils.normalize(name), utils.normalize(version))
+                if key in seen:
+                    continue
+                seen.add(key)
+
+                if data:
+                    logging.info("Cached {}:{}".format(*key))
+                elif self.is_version_blacklisted(name, version):
+                    logging.info("Blacklisted {}:{}".format(name, version))
+                else:
+                    candidates.append((name, version))
+
+            jobs.extend(self._select_candidates(
+                name,
+                versions,
+                candidates,
+                any(cached)
+            ))
+
+        self._run_jobs(jobs)
+
+        # register
+        for name, extra, versions in resolved:
+            for data in self.db.get_many(name, versions):
+                if data:
+                    self.add_todos_from_data(data, extra)
+
+            self.done_with_all_versions(name, extra)
+
+        self._process_requeued()
@@ -1,9 +1,22 @@
+import bisect
+import collections
+import hashlib
 import itertools
 import json
 import logging
 import os.path
 import pkg_resources
+import shlex
+import socket
 import subprocess
+import sys
+import time
+
+import pbsolver
+import profiling
+import records
+import solverdaemon
+import utils
 
 
 class VariableRegister(object):
@@ -49,50 +62,222 @@ class VariableRegister(object):
         return variable
 
 
-def solve(scheduler, db, must_satisfy, tmpdir, solver, outpath, include_starting_points=False):
-    register = VariableRegister()
+class VersionIndex(object):
+    """Sorted versions of all packages.
 
-    # get all names and known extras
-    name_extras = dict()
-    for name, extra in scheduler.done:
-        if name not in name_extras:
-            name_extras[name] = set()
-        name_extras[name].add(extra)
+    Answers which versions match a requirement by narrowing the candidates
+    with bisect based range lookups per specifier. Only the remaining
+    candidates are checked against the requirement itself. Results are
+    memoized per `(name, specs)`."""
+    def __init__(self, versions_register):
+        self.versions = dict(
+            (name, sorted(versions))
+            for name, versions in versions_register.iteritems()
+        )
+        self.cache = {}  # (name, specs) -> [version]
+
+    @staticmethod
+    def _upper_bound(versions, version):
+        # local versions (e.g. 1.0+foo) sort after 1.0,
+        # but match `==1.0` and `<=1.0`
+        hi = bisect.bisect_right(versions, version)
+        while hi < len(versions) \
+                and getattr(versions[hi], 'local', None) \
+                and pkg_resources.parse_version(versions[hi].public) == version:
+            hi += 1
+        return hi
+
+    def _range(self, versions, op, spec_version):
+        lo = 0
+        hi = len(versions)
+
+        version = pkg_resources.parse_version(spec_version)
+        if '*' in spec_version \
+                or getattr(version, 'local', None) \
+                or type(version).__name__ == 'LegacyVersion':
+            # wildcards, local and legacy specifiers do not follow the
+            # version order
+            return lo, hi
+
+        if op in ('>=', '~='):
+            lo = bisect.bisect_left(versions, version)
+        elif op == '>':
+            lo = bisect.bisect_right(versions, version)
+        elif op == '<':
+            hi = bisect.bisect_left(versions, version)
+        elif op == '<=':
+            hi = self._upper_bound(versions, version)
+        elif op == '==':
+            lo = bisect.bisect_left(versions, version)
+            hi = self._upper_bound(versions, version)
+
+        return lo, hi
+
+    def matching(self, name, requirement):
+        """Get all known versions of `name` that satisfy `requirement`."""
+        specs = tuple(sorted(requirement.specs))
+        key = (name, specs)
+        result = self.cache.get(key)
+        if result is not None:
+            return result
+
+        versions = self.versions.get(name, [])
+        if versions == [VariableRegister.VIRTUAL_VERSION]:
+            result = versions
+        else:
+            lo = 0
+            hi = len(versions)
+            for op, spec_version in specs:
+                spec_lo, spec_hi = self._range(versions, op, spec_version)
+                lo = max(lo, spec_lo)
+                hi = min(hi, spec_hi)
+
+            result = [
+                version
+                for version in versions[lo:hi]
+                if version in requirement
+            ]
+
+        self.cache[key] = result
+        return result
+
+
+def reduce_problem(package_versions, package_records, name_extras, must_satisfy):
+    """Find the `(name, version, extra)` nodes that matter for `must_satisfy`.
+
+    Starting at the roots, requirements are followed to all versions that
+    satisfy them. Nodes with a requirement that no remaining version can
+    satisfy are forbidden, the only way to satisfy a requirement of a forced
+    node is forced as well and forcing a version forbids all other versions
+    of that package. This is repeated until nothing changes.
+
+    Returns `(reachable nodes, forced nodes)`, where the forced nodes do not
+    include the roots, or `None` if there cannot be a solution."""
+    index = VersionIndex(dict(
+        (name, set(versions))
+        for name, versions in package_versions.iteritems()
+    ))
+    requirements_cache = {}  # node -> [[node]], alternatives per requirement
+    forbidden = set()
+
+    def requirements(node):
+        result = requirements_cache.get(node)
+        if result is None:
+            name, version, extra = node
+            result = []
+            if extra:
+                # extras require base
+                result.append([(name, version, '')])
+
+            data = package_records.get((name, version))
+            if data:
+                if extra:
+                    requirement_iter = data['extras_require'].get(extra, [])
+                else:
+                    requirement_iter = itertools.chain(data['install_requires'], data['tests_require'], data['setup_requires'])
+
+                # like in `requirement_constraints`, any of the versions
+                # with base or a requested extra satisfies a requirement
+                for requ_data in requirement_iter:
+                    result.append([
+                        (requ_data['name'], requ_version, requ_extra)
+                        for requ_version in index.matching(requ_data['name'], records.requirement(requ_data))
+                        for requ_extra in itertools.chain([''], requ_data['extras'])
+                    ])
+            requirements_cache[node] = result
+        return result
+
+    def allowed(node):
+        name, version, extra = node
+        return node not in forbidden \
+            and extra in name_extras.get(name, ()) \
+            and version in package_versions.get(name, ())
+
+    def available(alternatives):
+        return [node for node in alternatives if allowed(node)]
+
+    def closure(nodes, follow):
+        result = set(nodes)
+        stack = list(nodes)
+        while stack:
+            for alternatives in requirements(stack.pop()):
+                for node in follow(available(alternatives)):
+                    if node not in result:
+                        result.add(node)
+                        stack.append(node)
+        return result
+
+    roots = set(
+        (name, pkg_resources.parse_version(version), '')
+        for name, version in must_satisfy
+    )
+    while True:
+        if not all(allowed(root) for root in roots):
+            return None
+
+        reachable = closure(roots, lambda alternatives: alternatives)
+        changed = False
+        for node in reachable:
+            if not all(available(alternatives) for alternatives in requirements(node)):
+                forbidden.add(node)
+                changed = True
+        if changed:
+            continue
 
-    for name in name_extras.iterkeys():
-        name_extras[name].add("")
+        forced = closure(roots, lambda alternatives: alternatives if len(alternatives) == 1 else [])
+        forced_versions = {}  # name -> version
+        for name, version, _extra in forced:
+            if forced_versions.setdefault(name, version) != version:
+                return None
+        for node in reachable:
+            name, version, _extra = node
+            if forced_versions.get(name, version) != version:
+                forbidden.add(node)
+                changed = True
+        if not changed:
+            return reachable, forced - roots
+
+
+# enough for the counts of huge instances
+OPB_HEADER_WIDTH = 80
+
+# part of the problem digest, bump it if the meaning of solutions changes
+SOLUTION_FORMAT = 1
+
+# `solver` value that selects the in-process solver
+BUILTIN_SOLVER = "builtin"
+
+# packages: (name, version) -> set(extra), cost: value of the objective
+Solution = collections.namedtuple('Solution', ['packages', 'cost'])
+
+
+def version_weights(versions):
+    """Get `parsed version -> weight` for the optimization, newest version
+    has weight 0."""
+    return dict(
+        (version, weight)
+        for weight, version in enumerate(sorted(
+            set(pkg_resources.parse_version(str(v)) for v in versions),
+            reverse=True
+        ))
+    )
 
-    # register all names
-    # also compress single versions to set of versions if the
-    # requirements are identical
-    # FIXME separate extras from core
-    for name in name_extras.iterkeys():
-        all_versions = [
-            pkg_resources.parse_version(version)
-            for version in db.all_versions(name)
-        ]
-        if not all_versions:
-            logging.warn("Create virtual version for {}".format(name))
-            all_versions = [VariableRegister.VIRTUAL_VERSION]
 
-        aliases = {}
-        for version in all_versions:
-            data = db.get(name, str(version))
-            normalized = json.dumps(data, sort_keys=True)
-            if normalized not in aliases:
-                aliases[normalized] = set()
-            aliases[normalized].add(version)
-            register.register_single(name, version, name_extras[name])
+def requirement_constraints(register, package_records, index):
+    """Generate the clauses that link version sets to their requirements.
 
-        for data_json, versions in aliases.iteritems():
-            register.register_set(name, versions, name_extras[name])
+    Like all constraint generators, this yields `(terms, degree)` tuples that
+    stand for `sum(coefficient * x_variable for coefficient, variable in terms)
+    >= degree`.
 
-    opb_optimization = []
-    opb_clauses = []
+    Every distinct requirement gets exactly one virtual variable, which is
+    shared by all version sets that carry it. Requirements that are satisfied
+    by the same versions share their variable as well."""
+    requirement_variables = {}  # (name, specs, extras) -> variable
+    disjunction_variables = {}  # tuple(variable) -> variable
 
-    # clauses for requirements
     for (name, versions, extra), variable in register.map_set.iteritems():
-        data = db.get(name, str(iter(versions).next()))
+        data = package_records.get((name, iter(versions).next()))
         if not data:
             continue
 
@@ -106,150 +291,488 @@ def solve(scheduler, db, must_satisfy, tmpdir, solver, outpath, include_starting
         #     (V1 v v2 v ... v VN => SET)
         #     <=> ((V1 v V2 v .. v VN) v -SET)
         set_variable = register.get_virtual_variable()
-        setlink_clause = ""
-        for version in versions:
-            variable = register.map_single[(name, version, extra)]
-            setlink_clause += "-1 x{}  ".format(variable)
-        setlink_clause += "{} x{}  >=  0;".format(len(versions), set_variable)
-        opb_clauses.append(setlink_clause)
+        setlink_terms = [
+            (-1, register.map_single[(name, version, extra)])
+            for version in versions
+        ]
+        setlink_terms.append((len(versions), set_variable))
+        yield setlink_terms, 0
 
+        linked = set()
         for requ_data in requirement_iter:
-            # build requirement object from requ_data
-            # official version:
-            #
-            #     requirement_string = "{}".format(requ_data['name'])
-            #     if requ_data['specs']:
-            #         requirement_string += ','.join("{}{}".format(spec["op"], spec["version"]) for spec in requ_data['specs'])
-            #     requirement = pkg_resources.Requirement.parse(requirement_string)
-            #
-            # but that is too slow, so use the undocumented API
-            requirement = pkg_resources.Requirement(
+            key = (
                 requ_data['name'],
-                [(spec['op'], spec['version']) for spec in requ_data['specs']],
-                requ_data['extras']
+                tuple(sorted((spec['op'], spec['version']) for spec in requ_data['specs'])),
+                tuple(sorted(requ_data['extras']))
             )
-
-
-            # create virtual variable for that requirement
-            # and make the set variable require this virtual variable
-            virtual_variable = register.get_virtual_variable()
-            opb_clauses.append("-1 x{}  1 x{}  >=  0;".format(set_variable, virtual_variable))
-
-            # check all known versions against this requirement
-            # and put them in a possible set of satisfiying variable for the virtual object
-            # `VIRT => V1 v V2 v ... v VN`
-            or_clause = "-1 x{}".format(virtual_variable)
-            requ_versions = register.versions_register.get(requ_data['name'], set())
-            if not requ_versions:
-                # oops, we can never satisfy this
-                # opb_clauses.append("-1 x{}  >=  1;".format(variable))
-                pass # DEBUG
-            for requ_version in requ_versions:
-                if (requ_version == VariableRegister.VIRTUAL_VERSION) or (requ_version in requirement):
+            virtual_variable = requirement_variables.get(key)
+            if virtual_variable is None:
+                # check all known versions against this requirement
+                # and put them in a possible set of satisfiying variable for the virtual object
+                # `VIRT => V1 v V2 v ... v VN`
+                #
+                # if no version is left, the virtual variable is false and
+                # so is the set, `reduce_problem` usually removed it already
+                requirement = records.requirement(requ_data)
+                requ_variables = tuple(
+                    register.map_single[(requ_data['name'], requ_version, requ_extra)]
+                    for requ_version in index.matching(requ_data['name'], requirement)
                     # add constraint for base + all requested extras
-                    for requ_extra in itertools.chain([''], requ_data['extras']):
-                        requ_variable = register.map_single[(requ_data['name'], requ_version, requ_extra)]
-                        or_clause += "  1 x{}".format(requ_variable)
-
-            # finish the or-clause and push it
-            or_clause += "  >=  0;"
-            opb_clauses.append(or_clause)
-
-    # clauses for general information of packages
+                    for requ_extra in itertools.chain([''], key[2])
+                    if (requ_data['name'], requ_version, requ_extra) in register.map_single
+                )
+
+                virtual_variable = disjunction_variables.get(requ_variables)
+                if virtual_variable is None:
+                    # create virtual variable for that requirement
+                    virtual_variable = register.get_virtual_variable()
+                    disjunction_variables[requ_variables] = virtual_variable
+                    yield [(-1, virtual_variable)] + [
+                        (1, requ_variable)
+                        for requ_variable in requ_variables
+                    ], 0
+                requirement_variables[key] = virtual_variable
+
+            # make the set variable require this virtual variable
+            if virtual_variable not in linked:
+                linked.add(virtual_variable)
+                yield [(-1, set_variable), (1, virtual_variable)], 0
+
+
+def package_constraints(register, name_extras):
+    """Generate the clauses for general information of packages."""
     for name, versions in register.versions_register.iteritems():
         # maximum one version
-        opb_clauses.append(
-            "  ".join(
-                "-1 x{}".format(register.map_single[name, version, ''])
-                for version in versions
-            ) + "  >=  -1;"
-        )
+        yield [
+            (-1, register.map_single[name, version, ''])
+            for version in versions
+        ], -1
 
         # extras require base
         for version in versions:
             variable_base = register.map_single[name, version, '']
             for extra in name_extras[name]:
-                if extra:
-                    variable_extra = register.map_single[name, version, extra]
-                    opb_clauses.append("-1 x{}  1 x{}  >= 0;".format(variable_extra, variable_base))
+                variable_extra = register.map_single.get((name, version, extra))
+                if extra and variable_extra:
+                    yield [(-1, variable_extra), (1, variable_base)], 0
+
+
+def starting_point_constraints(register, must_satisfy):
+    for name, version in must_satisfy:
+        variable = register.map_single[(name, pkg_resources.parse_version(version), '')]
+        yield [(1, variable)], 1
+
+
+def forced_constraints(register, forced):
+    """Generate unit clauses for the nodes that `reduce_problem` forced."""
+    for node in forced:
+        yield [(1, register.map_single[node])], 1
+
+
+def objective(register, releases, costs, known_versions=None):
+    """Generate the `(weight, variable)` terms of the objective function and
+    fill `costs` (`variable -> weight`) on the way.
 
+    Versions are ranked within `known_versions` (`name -> versions`) if given,
+    so removing versions from the problem does not change the weights."""
+    for name, versions in register.versions_register.iteritems():
         # order versions by history for optimization
         # FIXME add ability to require minimal version
         # FIXME implement better weights for versions
         #       (e.g. 0.1.0, 0.1.1, 0.2.0)
-        for weight, version in enumerate(sorted(versions, reverse=True)):
-            opb_optimization.append("{} x{}".format(weight, register.map_single[name, version, '']))
+        ranking = set(versions)
+        if known_versions:
+            ranking.update(known_versions.get(name, []))
+        if releases:
+            ranking.update(releases.get(name, []))
+        weights = version_weights(ranking)
+        for version in versions:
+            variable = register.map_single[name, version, '']
+            costs[variable] = weights[version]
+            yield weights[version], variable
 
-    # initial starting point
-    for name, version in must_satisfy:
-        variable = register.map_single[(name, pkg_resources.parse_version(version), '')]
-        opb_clauses.append("1 x{}  >=  1;".format(variable))
 
-    # write opb file
-    opb_filepath = os.path.join(tmpdir, "to_solve.opb")
-    with open(opb_filepath, "w") as opb_file:
-        opb_file.write("* #variable= {} #constraint= {}\n".format(register.count, len(opb_clauses)))
+def write_opb(path, register, objective_terms, constraints):
+    """Stream an OPB instance to `path` and return the number of constraints.
+
+    The counts of the header are only known after all constraints are
+    generated, so a padded placeholder is written first and overwritten at
+    the end."""
+    with open(path, "w") as opb_file:
+        opb_file.write(" " * OPB_HEADER_WIDTH + "\n")
+
         opb_file.write("min: ")
-        for x in opb_optimization:
-            opb_file.write(x)
-            opb_file.write(" ")
+        for weight, variable in objective_terms:
+            opb_file.write("{} x{} ".format(weight, variable))
         opb_file.write(";\n")
 
-        for clause in opb_clauses:
-            opb_file.write(clause)
-            opb_file.write("\n")
+        count = 0
+        for terms, degree in constraints:
+            opb_file.write("  ".join(
+                "{} x{}".format(coefficient, variable)
+                for coefficient, variable in terms
+            ))
+            opb_file.write("  >=  {};\n".format(degree))
+            count += 1
 
-    logging.info("#Variables = {}   #Constraints= {}".format(register.count, len(opb_clauses)))
-    # run solver
-    result_path = os.path.join(tmpdir, "result.txt")
-    subprocess.check_call(
-        "{} {} | tee {}".format(solver, opb_filepath, result_path),
-        shell=True
+        # variables are numbered from 1 to register.count - 1
+        header = "* #variable= {} #constraint= {}".format(register.count - 1, count)
+        opb_file.seek(0)
+        opb_file.write(header.ljust(OPB_HEADER_WIDTH))
+
+    return count
+
+
+def parse_result(lines, echo=True):
+    """Parse solver output and return `(status, true variables)`.
+
+    If `echo` is set, the solver output is passed through to STDOUT while it
+    is parsed."""
+    result_status = None
+    result_result = set()
+    for line in lines:
+        if echo:
+            sys.stdout.write(line)
+        line = line.strip()
+        if line.startswith("s"):
+            result_status = line[2:]
+        elif line.startswith("v"):
+            # the assignment may be split over multiple lines
+            # only looking for true assigments
+            result_result.update(
+                int(part[1:])
+                for part in line[2:].split()
+                if part.startswith("x")
+            )
+    return result_status, result_result
+
+
+def run_solver(solver, opb_filepath, daemon=None):
+    """Run the solver on an OPB file and return `(status, true variables)`.
+
+    If `daemon` (a socket path) is set, the problem is passed to a running
+    `solverdaemon.SolverDaemon` first. The solver is run directly if that
+    fails."""
+    if daemon:
+        try:
+            # only show the output of the daemon if it is used, otherwise
+            # the output of the local solver follows
+            lines = list(solverdaemon.request(daemon, opb_filepath))
+            result = parse_result(lines, echo=False)
+            if result[0] is not None:
+                sys.stdout.writelines(lines)
+                return result
+            logging.warn("Solver daemon did not return a result")
+        except socket.error as e:
+            logging.warn("Cannot use solver daemon at {}: {}".format(daemon, e))
+
+    try:
+        process = subprocess.Popen(
+            shlex.split(solver) + [opb_filepath],
+            stdout=subprocess.PIPE
+        )
+    except OSError as e:
+        raise utils.HandledError("Cannot run solver '{}': {}", solver, e)
+    result = parse_result(iter(process.stdout.readline, ""))
+    process.stdout.close()
+
+    # PB solvers signal the result via the exit code (e.g. 30 = optimum),
+    # so it is only an error indicator if there is no status line
+    returncode = process.wait()
+    logging.debug("Solver exited with {}".format(returncode))
+    if returncode != 0 and result[0] is None:
+        raise utils.HandledError("Solver '{}' exited with {} without a result", solver, returncode)
+
+    return result
+
+
+def warm_start_variables(register, package_records, index, must_satisfy, previous):
+    """Map a previous solution (`[name, version, extras]` lists) to the
+    package variables of the current problem.
+
+    Returns `None` if the previous solution does not satisfy the current
+    problem anymore, e.g. because records or starting points changed."""
+    chosen = {}  # name -> (version, extras)
+    for name, version, extras in previous:
+        version = pkg_resources.parse_version(version)
+        if (name, version, '') in register.map_single:
+            chosen[name] = (version, set(extras) | set(['']))
+
+    for name, version in must_satisfy:
+        if chosen.get(name, (None, None))[0] != pkg_resources.parse_version(version):
+            return None
+
+    variables = set()
+    for name, (version, extras) in chosen.iteritems():
+        data = package_records.get((name, version))
+        for extra in extras:
+            variable = register.map_single.get((name, version, extra))
+            if variable is None:
+                return None
+            variables.add(variable)
+            if not data:
+                continue
+
+            if extra:
+                requirement_iter = data['extras_require'].get(extra, [])
+            else:
+                requirement_iter = itertools.chain(data['install_requires'], data['tests_require'], data['setup_requires'])
+
+            for requ_data in requirement_iter:
+                requ_chosen = chosen.get(requ_data['name'])
+                if requ_chosen is None:
+                    return None
+                requ_version, requ_extras = requ_chosen
+                if requ_version not in index.matching(requ_data['name'], records.requirement(requ_data)):
+                    return None
+                if not set(requ_data['extras']) <= requ_extras:
+                    return None
+
+    return variables
+
+
+def bound_constraints(costs, variables):
+    """Generate a constraint that only allows solutions that are at most as
+    expensive as the package variables `variables`. `costs` must be complete
+    when this is consumed, i.e. after the objective."""
+    cost = sum(costs.get(variable, 0) for variable in variables)
+    terms = [
+        (-weight, variable)
+        for variable, weight in costs.iteritems()
+        if weight
+    ]
+    if terms:
+        logging.info("Bound objective by previous solution to {}".format(cost))
+        yield terms, -cost
+
+
+def problem_digest(must_satisfy, name_extras, package_versions, releases, include_starting_points):
+    """Get a canonical SHA256 digest of everything that determines the
+    result of `solve`."""
+    digest = hashlib.sha256()
+    digest.update(json.dumps([
+        SOLUTION_FORMAT,
+        sorted(must_satisfy),
+        bool(include_starting_points)
+    ]))
+    for name in sorted(name_extras.iterkeys()):
+        digest.update(json.dumps([
+            name,
+            sorted(name_extras[name]),
+            sorted(releases.get(name, [])) if releases else None
+        ]))
+        for version, normalized in sorted(package_versions[name].iteritems()):
+            digest.update(json.dumps([str(version), normalized]))
+    return digest.hexdigest()
+
+
+def write_requirements(outpath, packages, must_satisfy, include_starting_points=False):
+    with open(outpath, "w") as outfile:
+        exclude = set()
+        if not include_starting_points:
+            exclude = set(name for name, _version in must_satisfy)
+
+        for (name, version), extras in sorted(
+                packages.iteritems(),
+                key=lambda ((name, _version), _extras): name):
+            if name not in exclude:
+                requirement_string = "{}".format(name)
+
+                if version != VariableRegister.VIRTUAL_VERSION:
+                    requirement_string += "=={}".format(version)
+
+                extras = extras - set([""])
+                if extras:
+                    requirement_string += "[" + ",".join(sorted(extras)) + "]"
+
+                outfile.write(requirement_string)
+                outfile.write("\n")
+
+    logging.info("Wrote requirements to {}".format(outpath))
+
+
+def solve(scheduler, db, must_satisfy, tmpdir, solver, outpath, include_starting_points=False, releases=None, builtin_threshold=0, daemon=None, solution_cache=False, warm_start=False, solution_max_age=None):
+    """Calculate and write an optimal set of requirements.
+
+    If `releases` (`name -> versions`) is given, versions are weighted by
+    their position within all releases instead of all known versions. The
+    built-in solver is used if `solver` is `BUILTIN_SOLVER` or if there are
+    at most `builtin_threshold` variables for package versions. External
+    solvers run via the solver daemon at `daemon` if it is set. If
+    `solution_cache` is set, solutions are stored in `db` and reused for
+    identical problems. If `warm_start` is set, the last solution for the
+    same root packages bounds the objective and guides the built-in solver.
+    Stored solutions older than `solution_max_age` seconds are ignored.
+    Returns a `Solution` or `None` if there is no solution."""
+    register = VariableRegister()
+    costs = {}  # variable -> weight
+
+    # get all names and known extras
+    name_extras = dict()
+    for name, extra in scheduler.done:
+        if name not in name_extras:
+            name_extras[name] = set()
+        name_extras[name].add(extra)
+
+    for name in name_extras.iterkeys():
+        name_extras[name].add("")
+
+    # get all records
+    package_records = {}   # (name, version) -> data
+    package_versions = {}  # name -> {version: normalized data}
+    for name in name_extras.iterkeys():
+        versions = {}
+        for version, data in db.all_records(name).iteritems():
+            version = pkg_resources.parse_version(version)
+            package_records[(name, version)] = data
+            versions[version] = json.dumps(data, sort_keys=True)
+        if not versions:
+            logging.warn("Create virtual version for {}".format(name))
+            versions[VariableRegister.VIRTUAL_VERSION] = json.dumps(None)
+        package_versions[name] = versions
+
+    digest = None
+    if solution_cache:
+        digest = problem_digest(must_satisfy, name_extras, package_versions, releases, include_starting_points)
+        cached = db.get_solution(digest, solution_max_age)
+        if cached:
+            logging.info("Use cached solution {}".format(digest))
+            packages = dict(
+                ((name, pkg_resources.parse_version(version)), set(extras))
+                for name, version, extras in cached['packages']
+            )
+            write_requirements(outpath, packages, must_satisfy, include_starting_points)
+            return Solution(packages, cached['cost'])
+
+    # only pass what the roots can reach to the solver
+    with profiling.measure("solver.reduce"):
+        reduced = reduce_problem(package_versions, package_records, name_extras, must_satisfy)
+    if reduced is None:
+        logging.error("Cannot find a solution, requirements of the starting points conflict")
+        return None
+    reachable, forced = reduced
+    logging.info("Kept {} of {} versions, {} are forced".format(
+        len(set((name, version) for name, version, _extra in reachable)),
+        sum(len(versions) for versions in package_versions.itervalues()),
+        len(set((name, version) for name, version, _extra in forced))
+    ))
+
+    # register all reachable names
+    # also compress single versions to set of versions if the
+    # requirements are identical
+    # FIXME separate extras from core
+    for name, normalized_versions in package_versions.iteritems():
+        aliases = {}
+        for version, normalized in normalized_versions.iteritems():
+            version_extras = [
+                extra
+                for extra in name_extras[name]
+                if (name, version, extra) in reachable
+            ]
+            if not version_extras:
+                continue
+            if normalized not in aliases:
+                aliases[normalized] = set()
+            aliases[normalized].add(version)
+            register.register_single(name, version, version_extras)
+
+        for data_json, versions in aliases.iteritems():
+            for extra in name_extras[name]:
+                extra_versions = [
+                    version
+                    for version in versions
+                    if (name, version, extra) in reachable
+                ]
+                if extra_versions:
+                    register.register_set(name, extra_versions, [extra])
+
+    index = VersionIndex(register.versions_register)
+    version_count = sum(len(versions) for versions in register.versions_register.itervalues())
+    builtin = solver == BUILTIN_SOLVER or version_count <= builtin_threshold
+
+    roots = set(name for name, _version in must_satisfy)
+    hints = None
+    if warm_start:
+        previous = db.get_warm_start(roots, solution_max_age)
+        if previous:
+            hints = warm_start_variables(register, package_records, index, must_satisfy, previous)
+            if hints is None:
+                logging.info("Previous solution is not valid anymore")
+
+    objective_terms = objective(register, releases, costs, package_versions)
+    constraints = itertools.chain(
+        requirement_constraints(register, package_records, index),
+        package_constraints(register, name_extras),
+        starting_point_constraints(register, must_satisfy),
+        forced_constraints(register, forced),
+        bound_constraints(costs, hints) if hints else []
+    )
+
+    start = time.time()
+    if builtin:
+        # small instance, solve it in-process
+        objective_terms = list(objective_terms)
+        constraints = list(constraints)
+        constraint_count = len(constraints)
+        generate_time = time.time() - start
+        logging.info("#Variables = {}   #Constraints= {}".format(register.count - 1, constraint_count))
+        result_status, result_result = pbsolver.Solver(
+            register.count - 1,
+            objective_terms,
+            constraints,
+            phases=hints
+        ).solve()
+    else:
+        # write opb file, constraints are streamed into it
+        opb_filepath = os.path.join(tmpdir, "to_solve.opb")
+        constraint_count = write_opb(
+            opb_filepath,
+            register,
+            objective_terms,
+            constraints
+        )
+        generate_time = time.time() - start
+
+        logging.info("#Variables = {}   #Constraints= {}".format(register.count - 1, constraint_count))
+        result_status, result_result = run_solver(solver, opb_filepath, daemon)
+
+    solve_time = time.time() - start - generate_time
+    profiling.add("solver.generate", generate_time)
+    profiling.add("solver.run", solve_time)
+    profiling.add_instance(
+        solver=BUILTIN_SOLVER if builtin else solver,
+        variables=register.count - 1,
+        constraints=constraint_count,
+        packages=len(register.versions_register),
+        versions=sum(len(versions) for versions in register.versions_register.itervalues()),
+        generate_time=generate_time,
+        solve_time=solve_time,
+        status=result_status
     )
 
     # analyze result
-    result_status = None
-    result_result = None
-    with open(result_path) as result_file:
-        for line in result_file:
-            line = line.strip()
-            if line.startswith("s"):
-                result_status = line[2:]
-            elif line.startswith("v"):
-                result_result = line[2:]
-    if result_status == "OPTIMUM FOUND":
+    if result_status == pbsolver.OPTIMUM_FOUND:
         packages = {}
-        for part in result_result.split(" "):
-            # only looking for true assigments
-            if part.startswith("x"):
-                variable = int(part[1:])
-                if variable in register.map_single_rev:
-                    name, version, extra = register.map_single_rev[variable]
-                    if (name, version) not in packages:
-                        packages[(name, version)] = set()
-                    packages[(name, version)].add(extra)
-
-        with open(outpath, "w") as outfile:
-            exclude = set()
-            if not include_starting_points:
-                exclude = set(name for name, _version in must_satisfy)
-
-            for (name, version), extras in sorted(
-                    packages.iteritems(),
-                    key=lambda ((name, _version), _extras): name):
-                if name not in exclude:
-                    requirement_string = "{}".format(name)
-
-                    if version != VariableRegister.VIRTUAL_VERSION:
-                        requirement_string += "=={}".format(version)
-
-                    extras.remove("")
-                    if extras:
-                        requirement_string += "[" + ",".join(sorted(extras)) + "]"
-
-                    outfile.write(requirement_string)
-                    outfile.write("\n")
-
-        logging.info("Wrote requirements to {}".format(outpath))
+        cost = 0
+        for variable in result_result:
+            cost += costs.get(variable, 0)
+            if variable in register.map_single_rev:
+                name, version, extra = register.map_single_rev[variable]
+                if (name, version) not in packages:
+                    packages[(name, version)] = set()
+                packages[(name, version)].add(extra)
+
+        encoded = [
+            [package_name, str(package_version), sorted(extras)]
+            for (package_name, package_version), extras in packages.iteritems()
+        ]
+        if digest:
+            db.set_solution(digest, encoded, cost)
+        if warm_start:
+            db.set_warm_start(roots, encoded)
+
+        write_requirements(outpath, packages, must_satisfy, include_starting_points)
+        return Solution(packages, cost)
     else:
         logging.error("Cannot find a solution")
+        return None
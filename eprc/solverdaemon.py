@@ -0,0 +1,180 @@
+import errno
+import fcntl
+import json
+import logging
+import os
+import os.path
+import shlex
+import shutil
+import socket
+import SocketServer
+import subprocess
+import tempfile
+import threading
+import time
+
+import utils
+
+
+DEFAULT_SOCKET = os.path.join(
+    os.path.expanduser("~"),
+    ".cache",
+    "eprc",
+    "solver.sock"
+)
+
+
+class _SpareSolver(object):
+    """Solver process that is already started and waits for its input on a
+    named pipe."""
+    def __init__(self, solver):
+        self.tmpdir = tempfile.mkdtemp(prefix="eprc-solver-")
+        self.fifo = os.path.join(self.tmpdir, "problem.opb")
+        os.mkfifo(self.fifo)
+        self.process = subprocess.Popen(
+            shlex.split(solver) + [self.fifo],
+            stdout=subprocess.PIPE
+        )
+
+    def _open_fifo(self):
+        # a non-blocking open fails until the solver opened the pipe for
+        # reading, which allows to detect solvers that died in the meantime
+        while True:
+            try:
+                fd = os.open(self.fifo, os.O_WRONLY | os.O_NONBLOCK)
+            except OSError as e:
+                if e.errno != errno.ENXIO:
+                    raise
+                if self.process.poll() is not None:
+                    raise IOError("Solver exited with {}".format(self.process.returncode))
+                time.sleep(0.01)
+                continue
+
+            flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+            fcntl.fcntl(fd, fcntl.F_SETFL, flags & ~os.O_NONBLOCK)
+            return os.fdopen(fd, "wb")
+
+    def _feed(self, path):
+        try:
+            with open(path, "rb") as infile, self._open_fifo() as fifo:
+                shutil.copyfileobj(infile, fifo)
+        except (IOError, OSError) as e:
+            logging.warn("Cannot pass problem to solver: {}".format(e))
+
+    def run(self, path, outfile):
+        """Solve the OPB file at `path` and write the solver output to
+        `outfile`."""
+        # the solver may write while it reads the problem
+        feeder = threading.Thread(target=self._feed, args=(path,))
+        feeder.daemon = True
+        feeder.start()
+        try:
+            for line in iter(self.process.stdout.readline, ""):
+                outfile.write(line)
+            self.process.wait()
+        finally:
+            feeder.join(1)
+            self.close()
+
+    def close(self):
+        if self.process.poll() is None:
+            self.process.kill()
+            self.process.wait()
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+
+class _Server(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+
+class _Handler(SocketServer.StreamRequestHandler):
+    def handle(self):
+        line = self.rfile.readline()
+        if not line:
+            # connection check, see `is_running`
+            return
+        request = json.loads(line)
+        self.server.solver_daemon.solve(request['path'], self.wfile)
+
+
+class SolverDaemon(object):
+    """Long-running service that solves OPB files for `eprc calc`.
+
+    Solver processes are started ahead of time and wait for their problem on
+    a named pipe, so the startup of the solver (e.g. the JVM of sat4j) is not
+    part of a request. Clients send `{"path": ...}` as a JSON line over a
+    unix socket and get the output of the solver back."""
+    def __init__(self, solver, socket_path=DEFAULT_SOCKET, spares=1):
+        self.solver = solver
+        self.socket_path = socket_path
+        self.spares = spares
+        self.ready = []
+        self.lock = threading.Lock()
+        self.server = None
+
+    def _take(self):
+        with self.lock:
+            spare = self.ready.pop() if self.ready else _SpareSolver(self.solver)
+            while len(self.ready) < self.spares:
+                self.ready.append(_SpareSolver(self.solver))
+        return spare
+
+    def solve(self, path, outfile):
+        logging.info("Solve {}".format(path))
+        self._take().run(path, outfile)
+
+    def serve_forever(self):
+        directory = os.path.dirname(self.socket_path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        if os.path.exists(self.socket_path):
+            if is_running(self.socket_path):
+                raise utils.HandledError("Solver daemon is already running at '{}'", self.socket_path)
+            os.remove(self.socket_path)
+
+        self.server = _Server(self.socket_path, _Handler)
+        self.server.solver_daemon = self
+        with self.lock:
+            while len(self.ready) < self.spares:
+                self.ready.append(_SpareSolver(self.solver))
+
+        logging.info("Listening on {}".format(self.socket_path))
+        try:
+            self.server.serve_forever()
+        finally:
+            self.close()
+
+    def close(self):
+        if self.server:
+            self.server.server_close()
+            self.server = None
+            if os.path.exists(self.socket_path):
+                os.remove(self.socket_path)
+        with self.lock:
+            for spare in self.ready:
+                spare.close()
+            self.ready = []
+
+
+def is_running(socket_path):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_path)
+        return True
+    except socket.error:
+        return False
+    finally:
+        sock.close()
+
+
+def request(socket_path, opb_filepath):
+    """Let the daemon at `socket_path` solve an OPB file, generates the lines
+    written by the solver. Raises `socket.error` if there is no daemon."""
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_path)
+        sock.sendall(json.dumps({'path': os.path.abspath(opb_filepath)}) + "\n")
+        for line in sock.makefile("rb"):
+            yield line
+    finally:
+        sock.close()
@@ -1,6 +1,7 @@
 import contextlib
 import re
 import shutil
+import sys
 import tempfile
 
 
@@ -25,3 +26,13 @@ def normalize(string):
         .replace("_", "-")
 
     return re.sub("[^a-z0-9.-]", "", string)
+
+
+def pool_map(pool, f, iterable):
+    """Like `map`, but uses `pool` (e.g. a `multiprocessing.pool.ThreadPool`)
+    if given."""
+    if pool:
+        # use map_async, because a plain map cannot be interrupted
+        return pool.map_async(f, iterable).get(sys.maxint)
+    else:
+        return map(f, iterable)
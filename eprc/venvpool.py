@@ -0,0 +1,102 @@
+import contextlib
+import logging
+import os
+import os.path
+import Queue
+import shutil
+import subprocess
+import tempfile
+import threading
+
+import profiling
+
+
+class VirtualenvError(Exception):
+    pass
+
+
+class VirtualenvPool(object):
+    """Pool of ready-to-use virtualenvs.
+
+    A template virtualenv, including `packages`, is only created once. The
+    environments handed out by `acquire` are hardlink clones of this template,
+    which is a lot faster than calling `virtualenv` and `pip` again. Clean
+    environments are reused, environments that were used by a failing run get
+    replaced by a fresh clone. Failures to create environments raise
+    `VirtualenvError`."""
+    def __init__(self, virtualenv, basedir, size=1, packages=None):
+        self.virtualenv = virtualenv
+        self.basedir = basedir
+        self.size = size
+        self.packages = list(packages or [])
+        self.template = None
+        self.slots = Queue.Queue()
+        self.created = 0
+        self.lock = threading.Lock()
+
+    def _build_template(self):
+        logging.debug("Build virtualenv template with {}".format(self.packages))
+        template = tempfile.mkdtemp(prefix="venv-template-", dir=self.basedir)
+        try:
+            with open(os.devnull, "w") as fnull, profiling.measure("venv.create"):
+                subprocess.check_call(
+                    [self.virtualenv, template],
+                    stdout=fnull
+                )
+
+                if self.packages:
+                    args = [os.path.join(template, "bin", "pip"), "install"]
+                    args.extend(self.packages)
+                    subprocess.check_call(
+                        args,
+                        stdout=fnull
+                    )
+        except (OSError, subprocess.CalledProcessError) as e:
+            shutil.rmtree(template, ignore_errors=True)
+            raise VirtualenvError("Cannot create virtualenv template: {}".format(e))
+
+        return template
+
+    def _clone(self):
+        venvdir = tempfile.mkdtemp(prefix="venv-", dir=self.basedir)
+        os.rmdir(venvdir)
+
+        # hardlinks are fine here, python replaces files (e.g. *.pyc) instead
+        # of modifying them
+        with profiling.measure("venv.clone"):
+            try:
+                subprocess.check_call(["cp", "-al", self.template, venvdir])
+            except (OSError, subprocess.CalledProcessError) as e:
+                shutil.rmtree(venvdir, ignore_errors=True)
+                raise VirtualenvError("Cannot clone virtualenv template: {}".format(e))
+        return venvdir
+
+    @contextlib.contextmanager
+    def acquire(self):
+        with self.lock:
+            if self.template is None:
+                self.template = self._build_template()
+
+            grow = self.slots.empty() and self.created < self.size
+            if grow:
+                self.created += 1
+
+        if grow:
+            try:
+                venvdir = self._clone()
+            except VirtualenvError:
+                with self.lock:
+                    self.created -= 1
+                raise
+        else:
+            venvdir = self.slots.get()
+
+        clean = False
+        try:
+            yield venvdir
+            clean = True
+        finally:
+            if not clean:
+                shutil.rmtree(venvdir)
+                venvdir = self._clone()
+            self.slots.put(venvdir)
@@ -17,7 +17,7 @@ with open(os.path.join('eprc', 'version.py'), 'rt') as fp:
 version = g['__version__']
 
 # autolist all packages
-packages = find_packages(exclude=['docs'])
+packages = find_packages(exclude=['docs', 'tests'])
 packages.append('eprc_docs')
 
 # ready!
@@ -35,6 +35,7 @@ setup(
     zip_safe=False,
     include_package_data=True,
     packages=packages,
+    test_suite='tests',
     package_dir={
         'eprc_docs': 'docs'
     },
@@ -45,7 +46,6 @@ setup(
     },
     install_requires=[
         'pip>=6.1.0',
-        'pkgtools>=0.7.0',
         'redis>=2.10.0',
     ],
     extras_require={
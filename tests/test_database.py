@@ -0,0 +1,71 @@
+import json
+import unittest
+
+from eprc import backends, database, utils
+
+
+RECORD = {
+    'name': 'foo',
+    'version': '1.0',
+    'setup_requires': [],
+    'install_requires': [],
+    'tests_require': [],
+    'extras_require': {}
+}
+
+
+class SchemaTest(unittest.TestCase):
+    def test_empty_database(self):
+        db = database.Database(backends.MemoryBackend())
+        db.check_schema()
+        db.set('foo', '1.0', RECORD)
+        db.check_schema()
+
+    def test_unmigrated_records(self):
+        backend = backends.MemoryBackend()
+        with backend.batch() as batch:
+            batch.set('foo:1.0', json.dumps(RECORD))
+        db = database.Database(backend)
+
+        # not in the version index yet
+        self.assertEqual(db.all_records('foo'), {})
+        self.assertRaises(utils.HandledError, db.check_schema)
+
+        self.assertEqual(db.migrate(), 1)
+        db.check_schema()
+        self.assertEqual(db.all_records('foo'), {'1.0': RECORD})
+
+
+class SolutionsTest(unittest.TestCase):
+    def setUp(self):
+        self.db = database.Database(backends.MemoryBackend())
+        self.db.set_solution('new', [['foo', '1.0', []]], 1)
+        self.db.set_solution('old', [['foo', '0.9', []]], 2)
+        self.db.set_warm_start(['foo'], [['foo', '1.0', []]])
+
+        # pretend that `old` was stored an hour ago
+        key = self.db.solution_key('old')
+        entry = json.loads(self.db.backend.data[key])
+        entry['timestamp'] -= 60 * 60
+        self.db.backend.data[key] = json.dumps(entry)
+
+    def test_max_age(self):
+        self.assertEqual(self.db.get_solution('old')['cost'], 2)
+        self.assertIsNone(self.db.get_solution('old', max_age=60))
+        self.assertEqual(self.db.get_solution('new', max_age=60)['cost'], 1)
+        self.assertEqual(self.db.get_warm_start(['foo'], max_age=60), [['foo', '1.0', []]])
+
+    def test_clear_solutions(self):
+        self.db.set('foo', '1.0', RECORD)
+        self.assertEqual(self.db.clear_solutions(max_age=60), 1)
+        self.assertIsNone(self.db.get_solution('old'))
+        self.assertIsNotNone(self.db.get_solution('new'))
+
+        self.assertEqual(self.db.clear_solutions(), 2)
+        self.assertIsNone(self.db.get_solution('new'))
+        self.assertIsNone(self.db.get_warm_start(['foo']))
+        self.assertEqual(self.db.get('foo', '1.0'), RECORD)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,123 @@
+import json
+import os.path
+import shutil
+import tempfile
+import unittest
+
+from eprc import pypi, utils
+
+
+class ParseFilenameTest(unittest.TestCase):
+    def test_sdists(self):
+        self.assertEqual(pypi._parse_filename('foo-1.0.tar.gz'), ('foo', '1.0', 'sdist'))
+        self.assertEqual(pypi._parse_filename('Foo-Bar-2.0.zip'), ('Foo-Bar', '2.0', 'sdist'))
+        self.assertEqual(pypi._parse_filename('pkg-1.0.dev-1.zip'), ('pkg', '1.0.dev-1', 'sdist'))
+        self.assertEqual(pypi._parse_filename('foo-1.0.tgz'), ('foo', '1.0', 'sdist'))
+
+    def test_wheels(self):
+        self.assertEqual(
+            pypi._parse_filename('Foo_Bar-2.0-py2.py3-none-any.whl'),
+            ('Foo_Bar', '2.0', 'bdist_wheel')
+        )
+
+    def test_other_files(self):
+        self.assertIsNone(pypi._parse_filename('README'))
+        self.assertIsNone(pypi._parse_filename('foo.tar.gz'))
+        self.assertIsNone(pypi._parse_filename('foo-1.0.whl'))
+
+
+class IndexTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def add_file(self, path):
+        path = os.path.join(self.directory, path)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'w') as outfile:
+            outfile.write(path)
+
+    def write_listing(self, packages, index_format=pypi.INDEX_FORMAT):
+        with open(os.path.join(self.directory, pypi.INDEX_FILENAME), 'w') as outfile:
+            json.dump({'format': index_format, 'packages': packages}, outfile)
+
+    def test_build_index(self):
+        self.add_file('foo/foo-1.0.tar.gz')
+        self.add_file('foo/foo-1.0-py2-none-any.whl')
+        self.add_file('README')
+        self.assertEqual(pypi.build_index(self.directory), 2)
+
+        index = pypi.load_index(self.directory)
+        real_name, releases = index['foo']
+        self.assertEqual(real_name, 'foo')
+        version, urls = releases['1.0']
+        self.assertEqual(version, '1.0')
+        self.assertEqual(
+            sorted((entry['filename'], entry['packagetype']) for entry in urls),
+            [('foo-1.0-py2-none-any.whl', 'bdist_wheel'), ('foo-1.0.tar.gz', 'sdist')]
+        )
+        for entry in urls:
+            self.assertTrue(entry['url'].startswith('file://'))
+            self.assertTrue(os.path.isfile(entry['url'][len('file://'):]))
+
+    def test_build_index_groups_spellings(self):
+        self.add_file('Foo-Bar-1.0.tar.gz')
+        self.add_file('Foo_Bar-2.0-py2-none-any.whl')
+        self.add_file('foo_bar-2.0.zip')
+        pypi.build_index(self.directory)
+
+        with open(os.path.join(self.directory, pypi.INDEX_FILENAME)) as infile:
+            packages = json.load(infile)['packages']
+        self.assertEqual(packages.keys(), ['Foo-Bar'])
+        self.assertEqual(sorted(packages['Foo-Bar']), ['1.0', '2.0'])
+        self.assertEqual(len(packages['Foo-Bar']['2.0']), 2)
+
+    def test_load_index_merges_spellings(self):
+        self.write_listing({
+            'a_b': {'1.0': [{'filename': 'a_b-1.0-py2-none-any.whl', 'packagetype': 'bdist_wheel', 'url': 'w'}]},
+            'A-B': {
+                '1.0': [{'filename': 'A-B-1.0.tar.gz', 'packagetype': 'sdist', 'url': 's'}],
+                '2.0': [{'filename': 'A-B-2.0.tar.gz', 'packagetype': 'sdist', 'url': 't'}]
+            }
+        })
+        index = pypi.load_index(os.path.join(self.directory, pypi.INDEX_FILENAME))
+
+        self.assertEqual(index.keys(), ['a-b'])
+        real_name, releases = index['a-b']
+        self.assertEqual(real_name, 'A-B')
+        self.assertEqual(sorted(releases), ['1.0', '2.0'])
+        self.assertEqual(
+            sorted(entry['filename'] for entry in releases['1.0'][1]),
+            ['A-B-1.0.tar.gz', 'a_b-1.0-py2-none-any.whl']
+        )
+
+    def test_load_index_errors(self):
+        self.assertRaises(utils.HandledError, pypi.load_index, self.directory)
+        self.write_listing({}, index_format=pypi.INDEX_FORMAT + 1)
+        self.assertRaises(utils.HandledError, pypi.load_index, self.directory)
+
+    def test_pypi(self):
+        self.add_file('Foo-Bar-1.0.tar.gz')
+        self.add_file('Foo_Bar-2.0-py2-none-any.whl')
+        pypi.build_index(self.directory)
+
+        index = pypi.PyPi(index='file://' + self.directory)
+        try:
+            (real_name, versions), missing = index.lookup_many(['foo_bar', 'missing'])
+            self.assertEqual(real_name, 'Foo-Bar')
+            self.assertEqual(sorted(versions), ['1.0', '2.0'])
+            self.assertIsNone(missing)
+            self.assertEqual(index.real_name('FOO-bar'), 'Foo-Bar')
+            self.assertEqual(
+                [entry['filename'] for entry in index.release_urls('foo-bar', '2.0')],
+                ['Foo_Bar-2.0-py2-none-any.whl']
+            )
+        finally:
+            index.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
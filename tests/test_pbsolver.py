@@ -0,0 +1,87 @@
+import itertools
+import random
+import unittest
+
+from eprc import pbsolver
+
+
+def brute_force(num_variables, objective, constraints):
+    """Return the optimal cost or `None` if there is no solution."""
+    best = None
+    for bits in itertools.product([0, 1], repeat=num_variables):
+        values = (0,) + bits
+        if all(
+                sum(coefficient * values[variable] for coefficient, variable in terms) >= degree
+                for terms, degree in constraints):
+            cost = sum(weight * values[variable] for weight, variable in objective)
+            if best is None or cost < best:
+                best = cost
+    return best
+
+
+def random_instance(rng):
+    num_variables = rng.randint(1, 8)
+    objective = [
+        (rng.randint(-3, 5), rng.randint(1, num_variables))
+        for _ in xrange(rng.randint(0, num_variables))
+    ]
+    constraints = []
+    for _ in xrange(rng.randint(0, 10)):
+        variables = rng.sample(xrange(1, num_variables + 1), rng.randint(1, min(num_variables, 5)))
+        terms = [(rng.choice([-3, -2, -1, -1, 1, 1, 1, 2, 4]), variable) for variable in variables]
+        constraints.append((terms, rng.randint(-2, 2)))
+    return num_variables, objective, constraints
+
+
+class SolverTest(unittest.TestCase):
+    def check(self, num_variables, objective, constraints, phases=None):
+        expected = brute_force(num_variables, objective, constraints)
+        status, result = pbsolver.Solver(num_variables, objective, constraints, phases).solve()
+        if expected is None:
+            self.assertEqual(status, pbsolver.UNSATISFIABLE)
+            return
+
+        self.assertEqual(status, pbsolver.OPTIMUM_FOUND)
+        values = [0] * (num_variables + 1)
+        for variable in result:
+            values[variable] = 1
+        for terms, degree in constraints:
+            self.assertGreaterEqual(
+                sum(coefficient * values[variable] for coefficient, variable in terms),
+                degree
+            )
+        self.assertEqual(
+            sum(weight * values[variable] for weight, variable in objective),
+            expected
+        )
+
+    def test_random_instances(self):
+        rng = random.Random(0)
+        for _ in xrange(500):
+            self.check(*random_instance(rng))
+
+    def test_random_instances_with_phases(self):
+        rng = random.Random(1)
+        for _ in xrange(200):
+            num_variables, objective, constraints = random_instance(rng)
+            phases = set(rng.sample(xrange(1, num_variables + 1), rng.randint(0, num_variables)))
+            self.check(num_variables, objective, constraints, phases)
+
+    def test_unsatisfiable(self):
+        constraints = [([(1, 1), (1, 2)], 2), ([(-1, 1)], 0)]
+        self.assertEqual(
+            pbsolver.Solver(2, [], constraints).solve(),
+            (pbsolver.UNSATISFIABLE, None)
+        )
+
+    def test_at_most_one_version(self):
+        # x1 or x2 is required, at most one of them, x1 is cheaper
+        constraints = [([(1, 1), (1, 2)], 1), ([(-1, 1), (-1, 2)], -1)]
+        self.assertEqual(
+            pbsolver.Solver(2, [(2, 1), (3, 2)], constraints).solve(),
+            (pbsolver.OPTIMUM_FOUND, set([1]))
+        )
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,97 @@
+import json
+import unittest
+
+from eprc import records
+
+
+def requirement_data(name, specs=(), extras=()):
+    return {
+        'name': name,
+        'specs': [{'op': op, 'version': version} for op, version in specs],
+        'extras': list(extras)
+    }
+
+
+DATA = {
+    'name': 'foo',
+    'version': '1.0',
+    'setup_requires': [requirement_data('setuptools', [('>=', '18.0')])],
+    'install_requires': [
+        requirement_data('bar', [('>=', '1.0'), ('<', '2.0')], ['fast']),
+        requirement_data('baz'),
+        requirement_data('qux', extras=['a', 'b'])
+    ],
+    'tests_require': [],
+    'extras_require': {
+        'docs': [requirement_data('sphinx', [('==', '1.3.*')])],
+        'empty': []
+    }
+}
+
+
+class RecordsTest(unittest.TestCase):
+    def test_roundtrip(self):
+        string = records.encode(DATA)
+        self.assertFalse(records.is_legacy(string))
+        self.assertEqual(records.decode(string), DATA)
+
+    def test_compact(self):
+        self.assertLess(len(records.encode(DATA)), len(json.dumps(DATA)))
+
+    def test_legacy_json(self):
+        string = json.dumps(DATA)
+        self.assertTrue(records.is_legacy(string))
+        self.assertEqual(records.decode(string), DATA)
+
+    def test_migrate_legacy_json(self):
+        string = records.encode(records.decode(json.dumps(DATA)))
+        self.assertFalse(records.is_legacy(string))
+        self.assertEqual(records.decode(string), DATA)
+
+    def test_unknown_version(self):
+        string = records.encode(DATA)
+        string = records.MAGIC + chr(records.FORMAT_VERSION + 1) + string[len(records.MAGIC) + 1:]
+        self.assertRaises(ValueError, records.decode, string)
+
+    def test_decoded_record_is_json(self):
+        data = records.decode(records.encode(DATA))
+        self.assertEqual(json.loads(json.dumps(data)), DATA)
+
+    def test_requirement(self):
+        data = records.decode(records.encode(DATA))
+        decoded = data['install_requires'][0]
+        requirement = records.requirement(decoded)
+        self.assertEqual(requirement.project_name, 'bar')
+        self.assertEqual(requirement.extras, ('fast',))
+        self.assertIn('1.5', requirement)
+        self.assertNotIn('2.0', requirement)
+
+        # parsed once per decoded requirement
+        self.assertIs(records.requirement(decoded), requirement)
+
+        # plain dicts (e.g. legacy records) give the same requirement
+        plain = DATA['install_requires'][0]
+        self.assertEqual(records.requirement(plain), requirement)
+        self.assertIs(records.requirement(plain), records.requirement(plain))
+
+    def test_shared_requirements(self):
+        first = records.decode(records.encode(DATA))
+        second = records.decode(records.encode(dict(DATA, version='2.0')))
+        self.assertIs(first['install_requires'][0], second['install_requires'][0])
+
+    def test_requirement_caches_are_bounded(self):
+        size = records.REQUIREMENT_CACHE_SIZE
+        records.REQUIREMENT_CACHE_SIZE = 10
+        try:
+            for i in xrange(25):
+                data = requirement_data('pkg{}'.format(i), [('>=', '1.0')])
+                records.requirement(data)
+                records.decode(records.encode(dict(DATA, install_requires=[data])))
+            self.assertLessEqual(len(records._requirement_cache), 10)
+            self.assertLessEqual(len(records._decoded_cache), 10)
+        finally:
+            records.REQUIREMENT_CACHE_SIZE = size
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,191 @@
+import logging
+import pkg_resources
+import random
+import shutil
+import tempfile
+import unittest
+
+from eprc import backends, database, solver
+
+
+def requirement_data(name, specs=(), extras=()):
+    return {
+        'name': name,
+        'specs': [{'op': op, 'version': version} for op, version in specs],
+        'extras': list(extras)
+    }
+
+
+def record(name, version, install_requires=(), extras_require=None):
+    return {
+        'name': name,
+        'version': version,
+        'setup_requires': [],
+        'install_requires': list(install_requires),
+        'tests_require': [],
+        'extras_require': extras_require or {}
+    }
+
+
+def reduce_problem(records, must_satisfy):
+    """Run `solver.reduce_problem` on a list of records, every package has the
+    extras that its records know."""
+    package_versions = {}
+    package_records = {}
+    name_extras = {}
+    for data in records:
+        version = pkg_resources.parse_version(data['version'])
+        package_versions.setdefault(data['name'], {})[version] = None
+        package_records[(data['name'], version)] = data
+        name_extras.setdefault(data['name'], set(['']))
+        name_extras[data['name']].update(data['extras_require'])
+    return solver.reduce_problem(package_versions, package_records, name_extras, must_satisfy)
+
+
+def node(name, version, extra=''):
+    return (name, pkg_resources.parse_version(version), extra)
+
+
+class ReduceProblemTest(unittest.TestCase):
+    def test_unreachable_and_unsatisfiable(self):
+        reachable, forced = reduce_problem([
+            record('root', '1', [requirement_data('a', [('>=', '2')])]),
+            record('a', '1'),
+            record('a', '2'),
+            record('a', '3', [requirement_data('b', [('<', '1')])]),
+            record('b', '1'),
+            record('c', '1')
+        ], [('root', '1')])
+
+        # a 1 is excluded by the requirement, a 3 cannot be installed and
+        # nothing requires c
+        self.assertEqual(reachable, set([node('root', '1'), node('a', '2')]))
+        self.assertEqual(forced, set([node('a', '2')]))
+
+    def test_forced_version_excludes_others(self):
+        reachable, forced = reduce_problem([
+            record('root', '1', [requirement_data('a'), requirement_data('b', [('==', '1')])]),
+            record('a', '1'),
+            record('a', '2'),
+            record('b', '1', [requirement_data('a', [('<', '2')])]),
+        ], [('root', '1')])
+
+        self.assertEqual(forced, set([node('b', '1'), node('a', '1')]))
+        self.assertNotIn(node('a', '2'), reachable)
+
+    def test_extras(self):
+        reachable, forced = reduce_problem([
+            record('root', '1', [requirement_data('a', extras=['x'])]),
+            record('a', '1', extras_require={'x': [requirement_data('b')]}),
+            record('b', '1'),
+        ], [('root', '1')])
+
+        # any node of the requirement satisfies it, so nothing is forced
+        self.assertEqual(
+            reachable,
+            set([node('root', '1'), node('a', '1'), node('a', '1', 'x'), node('b', '1')])
+        )
+        self.assertEqual(forced, set())
+
+    def test_conflict(self):
+        self.assertIsNone(reduce_problem([
+            record('root', '1', [requirement_data('a', [('==', '1')]), requirement_data('b')]),
+            record('a', '1'),
+            record('a', '2'),
+            record('b', '1', [requirement_data('a', [('==', '2')])]),
+        ], [('root', '1')]))
+
+    def test_unsatisfiable_root(self):
+        self.assertIsNone(reduce_problem([
+            record('root', '1', [requirement_data('a', [('>', '1')])]),
+            record('a', '1'),
+        ], [('root', '1')]))
+
+
+class _Scheduler(object):
+    def __init__(self, done):
+        self.done = done
+
+
+def random_requirement(rng, names, version_count):
+    op = rng.choice(['>=', '<', '!=', '==', None, None, None])
+    specs = [(op, str(rng.randint(0, version_count)))] if op else []
+    extras = ['x'] if rng.random() < 0.2 else []
+    return requirement_data(rng.choice(names * 6 + ['missing']), specs, extras)
+
+
+def random_universe(rng, db):
+    names = ['p{}'.format(i) for i in xrange(rng.randint(2, 6))]
+    version_count = rng.randint(1, 4)
+    for name in names:
+        for version in xrange(version_count):
+            if rng.random() < 0.2:
+                continue
+            extras_require = {}
+            if rng.random() < 0.5:
+                extras_require['x'] = [
+                    random_requirement(rng, names, version_count)
+                    for _ in xrange(rng.randint(0, 2))
+                ]
+            db.set(name, str(version), record(
+                name,
+                str(version),
+                [random_requirement(rng, names, version_count) for _ in xrange(rng.randint(0, 3))],
+                extras_require
+            ))
+    db.set('root', '1', record('root', '1', [random_requirement(rng, names, version_count) for _ in xrange(2)]))
+
+    return _Scheduler(
+        set((name, '') for name in names + ['root', 'missing'])
+        | set((name, 'x') for name in names + ['missing'])
+    )
+
+
+class SolveTest(unittest.TestCase):
+    """The reduction must not change the optimum."""
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        logging.disable(logging.CRITICAL)
+
+    def tearDown(self):
+        logging.disable(logging.NOTSET)
+        shutil.rmtree(self.tmpdir)
+
+    def solve(self, scheduler, db):
+        solution = solver.solve(
+            scheduler,
+            db,
+            [('root', '1')],
+            self.tmpdir,
+            solver.BUILTIN_SOLVER,
+            self.tmpdir + '/requirements.txt'
+        )
+        return solution and solution.cost
+
+    def test_same_optimum(self):
+        def keep_everything(package_versions, package_records, name_extras, must_satisfy):
+            nodes = set(
+                (name, version, extra)
+                for name, versions in package_versions.iteritems()
+                for version in versions
+                for extra in name_extras[name]
+            )
+            return nodes, set()
+
+        for seed in xrange(60):
+            db = database.Database(backends.MemoryBackend())
+            scheduler = random_universe(random.Random(seed), db)
+            reduced = self.solve(scheduler, db)
+
+            reduce_problem = solver.reduce_problem
+            solver.reduce_problem = keep_everything
+            try:
+                expected = self.solve(scheduler, db)
+            finally:
+                solver.reduce_problem = reduce_problem
+
+            self.assertEqual(reduced, expected, "seed {}".format(seed))
+
+
+if __name__ == '__main__':
+    unittest.main()